@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of grouping an indicator's rows by country in get_countriesdata.
+
+Run from the repository root with: python -m benchmarks.bucketing [--rows 20000] [--scaled-rows 1000000]
+
+The legacy implementation copies each country list (and the world list) on every row so it is quadratic. Both
+implementations group the same number of rows, generated afresh for each so that neither shares the other's row
+dicts and tracemalloc sees each one's rows. Timings include generating the rows. With --scaled-rows, the current
+implementation alone is also run on that many rows, as running the legacy one on 1M rows takes hours.
+
+"""
+import argparse
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.synthetic import SyntheticDownloader, generate_rows, headers_for
+from unicef import WORLD, get_countriesdata
+
+
+def legacy_get_countriesdata(url, downloader, with_world=True):
+    headers, iterator = downloader.get_tabular_rows(url, dict_form=True)
+    countriesdata = dict()
+    for row in iterator:
+        countryiso3 = row["REF_AREA"]
+        countriesdata[countryiso3] = countriesdata.get(countryiso3, []) + [row]
+        if with_world:
+            countriesdata[WORLD] = countriesdata.get(WORLD, []) + [row]
+    return countriesdata, headers
+
+
+def measure(function, rows, countries):
+    """Group freshly generated rows with function returning seconds, retained and peak bytes."""
+    periods = -(-rows // countries)
+    input = generate_rows(countries=countries, periods=periods)
+    downloader = SyntheticDownloader({"synthetic": (headers_for(), (row for _, row in zip(range(rows), input)))})
+    tracemalloc.start()
+    start = perf_counter()
+    countriesdata, headers = function("synthetic", downloader)
+    elapsed = perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, peak
+
+
+def main(rows, countries, scaled_rows=None):
+    print("%d countries" % countries)
+    print("%-16s %10s %12s %14s %14s" % ("impl", "rows", "seconds", "retained MiB", "peak MiB"))
+    variants = [("legacy", legacy_get_countriesdata, rows), ("current", get_countriesdata, rows)]
+    if scaled_rows:
+        variants.append(("current (scaled)", get_countriesdata, scaled_rows))
+    for name, function, norows in variants:
+        elapsed, current, peak = measure(function, norows, countries)
+        print("%-16s %10d %12.3f %14.1f %14.1f" % (name, norows, elapsed, current / 2 ** 20, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark country bucketing")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--scaled-rows", type=int, default=None)
+    parser.add_argument("--countries", type=int, default=250)
+    args = parser.parse_args()
+    main(args.rows, args.countries, args.scaled_rows)
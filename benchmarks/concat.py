@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of concat_reports on the world dataset against the previous implementation, which sorted and scanned the
+header list for the fields of every row.
+
+Run from the repository root with: python -m benchmarks.concat [--countries 200] [--indicators 30] [--periods 24]
+
+"""
+import argparse
+from time import perf_counter
+
+from benchmarks.synthetic import SyntheticDownloader, generate_rows, headers_for, use_offline_country_data
+from unicef import CONCAT_KEY_FIELDS, WORLD, concat_reports, get_all_countriesdata
+
+
+def legacy_concat_reports(countrydata):
+    headers = CONCAT_KEY_FIELDS[:]
+    rows = []
+    for report_id in sorted(countrydata.keys()):
+        report_rows = countrydata[report_id]
+        for report_row in report_rows:
+            rows.append(report_row)
+            for field in sorted(report_row.keys()):
+                if field not in headers:
+                    headers.append(field)
+    return rows, headers
+
+
+def listed_concat_reports(countrydata, headers):
+    """concat_reports with its rows (yielded lazily) in a list, to compare with the previous implementation."""
+    rows, concatheaders = concat_reports(countrydata, headers)
+    return list(rows), concatheaders
+
+
+def best_of(repeats, function, *args):
+    timings = list()
+    for _ in range(repeats):
+        start = perf_counter()
+        result = function(*args)
+        timings.append(perf_counter() - start)
+    return min(timings), result
+
+
+def main(countries, indicators, periods, extra_columns, repeats):
+    use_offline_country_data()
+    reports = dict()
+    config = dict()
+    for indicator in range(indicators):
+        report_id = "CV_%02d" % indicator
+        url = "synthetic://%s" % report_id
+        config[report_id] = {"url": url}
+        rows = list(generate_rows(countries, 1, periods, extra_columns, indicator_offset=indicator))
+        reports[url] = (headers_for(extra_columns), rows)
+    _, countriesdata, headers = get_all_countriesdata(config, SyntheticDownloader(reports))
+    world = countriesdata[WORLD]
+    legacy_time, (legacy_rows, legacy_headers) = best_of(repeats, legacy_concat_reports, world)
+    current_time, (rows, concatheaders) = best_of(repeats, listed_concat_reports, world, headers)
+    assert concatheaders == legacy_headers
+    assert rows == legacy_rows
+    print("world dataset: %d rows, %d columns" % (len(rows), len(concatheaders)))
+    print("legacy  %8.3fs" % legacy_time)
+    print("current %8.3fs (%.1fx)" % (current_time, legacy_time / current_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concat_reports")
+    parser.add_argument("--countries", type=int, default=200)
+    parser.add_argument("--indicators", type=int, default=30)
+    parser.add_argument("--periods", type=int, default=24)
+    parser.add_argument("--extra-columns", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    main(args.countries, args.indicators, args.periods, args.extra_columns, args.repeats)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the join_reports engines on the world dataset.
+
+Run from the repository root with: python -m benchmarks.join [--countries 200] [--indicators 30] [--periods 24]
+
+"""
+import argparse
+
+from benchmarks.concat import best_of
+from benchmarks.synthetic import SyntheticDownloader, generate_rows, headers_for, use_offline_country_data
+from unicef import WORLD, get_all_countriesdata, join_reports
+
+
+def listed_join_reports(countrydata, config, engine="python"):
+    """join_reports with its rows (yielded lazily) in a list, so that the engines' outputs can be compared."""
+    rows, headers = join_reports(countrydata, config, engine)
+    return list(rows), headers
+
+
+def main(countries, indicators, periods, repeats):
+    use_offline_country_data()
+    reports = dict()
+    config = dict()
+    for indicator in range(indicators):
+        report_id = "CV_%02d" % indicator
+        url = "synthetic://%s" % report_id
+        config[report_id] = {
+            "url": url,
+            "observation_field": "Observation %d" % indicator,
+            "target_field": "Target %d" % indicator,
+        }
+        rows = list(generate_rows(countries, 1, periods, indicator_offset=indicator))
+        reports[url] = (headers_for(), rows)
+    _, countriesdata, headers = get_all_countriesdata(config, SyntheticDownloader(reports))
+    world = countriesdata[WORLD]
+    python_time, python_result = best_of(repeats, listed_join_reports, world, config)
+    pandas_time, pandas_result = best_of(repeats, listed_join_reports, world, config, "pandas")
+    assert pandas_result == python_result
+    print("world dataset: %d rows joined into %d rows" % (
+        sum(len(rows) for rows in world.values()), len(python_result[0])))
+    print("python %8.3fs" % python_time)
+    print("pandas %8.3fs" % pandas_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark join_reports")
+    parser.add_argument("--countries", type=int, default=200)
+    parser.add_argument("--indicators", type=int, default=30)
+    parser.add_argument("--periods", type=int, default=24)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    main(args.countries, args.indicators, args.periods, args.repeats)
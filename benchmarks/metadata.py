@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the per-country metadata work of generate_dataset_and_showcase for a run of 200 countries: working it
+out for every country (as before RunMetadata) versus working it out once and looking it up.
+
+Run from the repository root with: python -m benchmarks.metadata [--countries 200] [--repeats 5]
+
+"""
+import argparse
+import logging
+from copy import deepcopy
+from os.path import join
+
+from hdx.data.dataset import Dataset
+from hdx.data.hdxobject import HDXError
+from hdx.data.showcase import Showcase
+from hdx.utilities.loader import load_yaml
+from slugify import slugify
+
+from benchmarks.concat import best_of
+from benchmarks.synthetic import iso3_codes, stub_hdx
+from registry import IndicatorRegistry
+from unicef import QC_CUTDOWN_HASHTAGS, TAGS, RunMetadata, countries_from_iso_list, hxltags, hxltags_from_config
+
+
+def legacy_metadata(countries, config, qc_indicators):
+    """Dataset, showcase and hashtag set up done for every country before RunMetadata."""
+    for country in countries:
+        countryiso = country["iso3"].lower()
+        title = "%s - COVID-19 Situation Report" % country["name"]
+        name = "UNICEF COVID-19 situation report for %s" % country["name"]
+        slugified_name = slugify(name).lower()
+        dataset = Dataset({"name": slugified_name, "title": title})
+        dataset.set_maintainer("196196be-6037-4488-8b71-d786adf4c081")
+        dataset.set_organization("3ab17ac1-1196-4501-a4dc-a01d2e52ff7c")
+        dataset.set_subnational(False)
+        dataset.set_expected_update_frequency("Every month")
+        dataset.add_tags(TAGS)
+        try:
+            dataset.add_country_location(countryiso)
+        except HDXError:
+            continue
+        config_hxltags = {**hxltags, **hxltags_from_config(config)}
+        [x["code"] for x in qc_indicators]
+        [key for key, value in config_hxltags.items() if value in QC_CUTDOWN_HASHTAGS]
+        {**hxltags, **hxltags_from_config(config)}
+        showcase = Showcase({"name": "%s-showcase" % slugified_name, "title": name})
+        showcase.add_tags(TAGS)
+
+
+def run_metadata(countries, config, qc_indicators):
+    """RunMetadata built once for the run, then only lookups and copies of the templates per country."""
+    metadata = RunMetadata(config, qc_indicators, countries)
+    for country in countries:
+        countrymetadata = metadata.country(country)
+        dataset = Dataset(
+            {"name": countrymetadata["slugified_name"], "title": countrymetadata["title"],
+             **deepcopy(metadata.dataset_template)}
+        )
+        dataset["groups"] = deepcopy(countrymetadata["groups"])
+        Showcase({"name": "%s-showcase" % countrymetadata["slugified_name"], "title": countrymetadata["name"],
+                  **deepcopy(metadata.showcase_template)})
+
+
+def main(countries, repeats):
+    logging.getLogger().setLevel(logging.WARNING)
+    stub_hdx(countries)
+    config = IndicatorRegistry(load_yaml(join("config", "project_configuration.yml")))
+    qc_indicators = config.settings["qc_indicators"]
+    countrylist = countries_from_iso_list(iso3_codes(countries))
+    # The report configurations as a plain dictionary, whose hashtags are found by scanning it as before the registry
+    legacy_time, _ = best_of(repeats, legacy_metadata, countrylist, dict(config), qc_indicators)
+    metadata_time, _ = best_of(repeats, run_metadata, countrylist, config, qc_indicators)
+    print("%d countries, %d reports" % (len(countrylist), len(config)))
+    print("per country  %8.3fs" % legacy_time)
+    print("run metadata %8.3fs" % metadata_time)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark run metadata")
+    parser.add_argument("--countries", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    main(args.countries, args.repeats)
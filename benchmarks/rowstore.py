@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the memory held by the rows of get_countriesdata: dictionary rows versus compact Row objects.
+
+Run from the repository root with: python -m benchmarks.rowstore [--rows 1000000]
+
+"""
+import argparse
+import csv
+import gc
+import tracemalloc
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from benchmarks.synthetic import SyntheticDownloader, generate_rows, headers_for, write_csv
+from unicef import WORLD, WorldView, get_countriesdata
+
+
+def dict_get_countriesdata(url, downloader, with_world=True):
+    headers, iterator = downloader.get_tabular_rows(url, dict_form=True)
+    countriesdata = dict()
+    for row in iterator:
+        countriesdata.setdefault(row["REF_AREA"], []).append(dict(row))
+    if with_world:
+        countriesdata[WORLD] = WorldView(countriesdata)
+    return countriesdata, headers
+
+
+def measure(function, downloader):
+    gc.collect()
+    tracemalloc.start()
+    start = perf_counter()
+    countriesdata, headers = function("synthetic", downloader)
+    elapsed = perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del countriesdata
+    return elapsed, current, peak
+
+
+def main(rows, countries):
+    periods = -(-rows // countries)
+    with TemporaryDirectory() as folder:
+        path = join(folder, "indicator.csv")
+        headers = headers_for()
+        write_csv(path, generate_rows(countries=countries, periods=periods), headers)
+        with open(path, newline="", encoding="utf-8") as input:
+            allrows = list(csv.DictReader(input))[:rows]
+    print("%d rows, %d columns, %d countries" % (len(allrows), len(headers), countries))
+    print("%-8s %12s %14s %14s" % ("rows", "seconds", "retained MiB", "peak MiB"))
+    for name, function in (("dict", dict_get_countriesdata), ("compact", get_countriesdata)):
+        downloader = SyntheticDownloader({"synthetic": (headers, allrows)})
+        elapsed, current, peak = measure(function, downloader)
+        print("%-8s %12.3f %14.1f %14.1f" % (name, elapsed, current / 2 ** 20, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark row representation memory")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--countries", type=int, default=250)
+    args = parser.parse_args()
+    main(args.rows, args.countries)
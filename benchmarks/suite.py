@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite covering the scrape pipeline from downloading situation reports to generating datasets.
+
+Run from the repository root with: python -m benchmarks.suite [--scale small medium] [--output results.json]
+[--compare previous.json]
+
+Synthetic SDMX csvs are written to a temporary folder and read with a real Download object, so the suite runs
+offline. HDX is stubbed: datasets and showcases are generated but never created on HDX. The timings (and the memory
+retained by the fetched rows) of each scale point are written as JSON so that results from different runs can be
+compared with --compare.
+
+"""
+import argparse
+import gc
+import json
+import logging
+import platform
+import tracemalloc
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+
+from benchmarks.concat import best_of
+from benchmarks.synthetic import stub_hdx, write_reports
+from unicef import (
+    WORLD,
+    concat_reports,
+    generate_dataset_and_showcase,
+    get_all_countriesdata,
+    get_countriesdata,
+    hxltags_from_config,
+    join_reports,
+)
+
+# countries, indicators, time periods and extra columns of each scale point
+SCALE_POINTS = {
+    "small": {"countries": 20, "indicators": 3, "periods": 12, "extra_columns": 0},
+    "medium": {"countries": 100, "indicators": 10, "periods": 24, "extra_columns": 2},
+    "large": {"countries": 249, "indicators": 18, "periods": 36, "extra_columns": 4},
+}
+
+
+def drain(function, *args):
+    """Call a function returning rows (yielded lazily) and headers and iterate over the rows."""
+    rows, headers = function(*args)
+    return sum(1 for _ in rows), headers
+
+
+def retained(function, *args):
+    """MiB allocated by a function and still held (by its result) when it returns, traced with tracemalloc."""
+    gc.collect()
+    tracemalloc.start()
+    result = function(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current / 2 ** 20
+
+
+def generate_all(folder, countries, countriesdata, headers, config, qc_indicators):
+    datasets = 0
+    for country in countries:
+        dataset, _, _ = generate_dataset_and_showcase(
+            folder, country, countriesdata[country["iso3"]], headers, config, qc_indicators
+        )
+        if dataset:
+            datasets += 1
+    return datasets
+
+
+def run_scale_point(parameters, repeats):
+    timings = dict()
+    with TemporaryDirectory() as folder:
+        config = write_reports(folder, **parameters)
+        stub_hdx(parameters["countries"])
+        qc_indicators = [{"code": reportconfig["identifier"]} for reportconfig in list(config.values())[:3]]
+        with Download(user_agent="benchmark") as downloader:
+            first_url = next(iter(config.values()))["url"]
+            timings["get_countriesdata"], _ = best_of(repeats, get_countriesdata, first_url, downloader)
+            timings["get_all_countriesdata"], result = best_of(repeats, get_all_countriesdata, config, downloader)
+            # Rows are held as compact tuples with interned strings, trading CPU time in get_countriesdata for memory
+            memory = {"get_all_countriesdata": retained(get_all_countriesdata, config, downloader)}
+        countries, countriesdata, headers = result
+        world = countriesdata[WORLD]
+        timings["concat_reports"], _ = best_of(repeats, drain, concat_reports, world, headers)
+        timings["join_reports"], _ = best_of(repeats, drain, join_reports, world, config)
+        timings["hxltags_from_config"], _ = best_of(repeats, hxltags_from_config, config)
+        with temp_dir("benchmark_suite", delete_if_exists=True) as output:
+            timings["generate_dataset_and_showcase"], datasets = best_of(
+                repeats, generate_all, output, countries, countriesdata, headers, config, qc_indicators
+            )
+        rows = sum(len(rows) for rows in world.values())
+    return {"parameters": parameters, "rows": rows, "datasets": datasets, "timings": timings, "retained_mib": memory}
+
+
+def compare(results, previous):
+    print("%-8s %-30s %10s %10s %8s" % ("scale", "function", "previous", "current", "ratio"))
+    for scale, result in results["scale_points"].items():
+        before = previous["scale_points"].get(scale)
+        if before is None or before["parameters"] != result["parameters"]:
+            print("%-8s not comparable" % scale)
+            continue
+        for function, seconds in result["timings"].items():
+            old = before["timings"].get(function)
+            if old:
+                print("%-8s %-30s %10.3f %10.3f %8.2f" % (scale, function, old, seconds, seconds / old))
+        for function, mib in result["retained_mib"].items():
+            old = before.get("retained_mib", {}).get(function)
+            if old:
+                print("%-8s %-30s %10.1f %10.1f %8.2f" % (scale, "%s MiB" % function, old, mib, mib / old))
+
+
+def main(scales, repeats, output, previous):
+    logging.getLogger().setLevel(logging.WARNING)
+    results = {"python": platform.python_version(), "repeats": repeats, "scale_points": dict()}
+    for scale in scales:
+        result = run_scale_point(SCALE_POINTS[scale], repeats)
+        results["scale_points"][scale] = result
+        print("%s: %d rows, %d datasets" % (scale, result["rows"], result["datasets"]))
+        for function, seconds in result["timings"].items():
+            print("  %-30s %8.3fs" % (function, seconds))
+        for function, mib in result["retained_mib"].items():
+            print("  %-30s %8.1fMiB retained" % (function, mib))
+    with open(output, "w", encoding="utf-8") as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    if previous:
+        with open(previous, encoding="utf-8") as infile:
+            compare(results, json.load(infile))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scrape pipeline")
+    parser.add_argument("--scale", nargs="+", choices=list(SCALE_POINTS), default=["small", "medium"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=join("benchmarks", "results.json"))
+    parser.add_argument("--compare", dest="previous", default=None)
+    args = parser.parse_args()
+    main(args.scale, args.repeats, args.output, args.previous)
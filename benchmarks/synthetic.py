@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Synthetic SDMX data:
+-------------------
+
+Generates situation report rows shaped like the csv returned by the UNICEF SDMX endpoint.
+
+"""
+import csv
+from datetime import date
+from os.path import join
+
+from hdx.location.country import Country
+
+import tests
+
+SDMX_HEADERS = [
+    "DATAFLOW",
+    "REF_AREA",
+    "Geographic area",
+    "SITREP_INDICATOR",
+    "Situation Report Indicator",
+    "HAC_PILLAR",
+    "Humanitarian Action for Children Pillar",
+    "UNIT_MEASURE",
+    "Unit of measure",
+    "TIME_PERIOD",
+    "OBS_VALUE",
+    "DATA_SOURCE",
+    "TARGET",
+    "OBS_STATUS",
+    "Observation status",
+]
+
+
+def use_offline_country_data():
+    """Use the country data bundled with hdx-python-country so that country lookups do not need the network."""
+    Country.countriesdata(use_live=False)
+
+
+def country_codes(countries):
+    """Return a list of distinct three letter country codes."""
+    codes = list()
+    for i in range(countries):
+        codes.append(chr(65 + i // 676 % 26) + chr(65 + i // 26 % 26) + chr(65 + i % 26))
+    return codes
+
+
+def iso3_codes(countries):
+    """Return the first countries real three letter country codes (needed where datasets are generated)."""
+    codes = sorted(Country.countriesdata(use_live=False)["countries"].keys())
+    if countries > len(codes):
+        raise ValueError("Only %d countries are available" % len(codes))
+    return codes[:countries]
+
+
+def time_periods(periods, start_year=2020):
+    """Return a list of monthly time periods eg. 2020-04-30 (situation reports are dated to the day)."""
+    return [date(start_year + i // 12, i % 12 + 1, 28).strftime("%Y-%m-%d") for i in range(periods)]
+
+
+def generate_rows(countries=200, indicators=1, periods=24, extra_columns=0, indicator_offset=0, codes=None):
+    """
+    Yield rows in dict form for every combination of indicator, country and time period, ordered like SDMX output
+    (by indicator, then country, then time period). Made up country codes are used unless codes are given.
+    """
+    if codes is None:
+        codes = country_codes(countries)
+    timeperiods = time_periods(periods)
+    extra = ["EXTRA_%d" % i for i in range(extra_columns)]
+    for indicator in range(indicator_offset, indicator_offset + indicators):
+        indicator_code = "CV-%02d-%02d" % (indicator // 10 + 1, indicator % 10 + 1)
+        for countryiso in codes:
+            for i, timeperiod in enumerate(timeperiods):
+                row = {
+                    "DATAFLOW": "UNICEF.EMOPS:DF_SITREP_COVID19(1.0)",
+                    "REF_AREA": countryiso,
+                    "Geographic area": "Country %s" % countryiso,
+                    "SITREP_INDICATOR": indicator_code,
+                    "Situation Report Indicator": "Indicator %s" % indicator_code,
+                    "HAC_PILLAR": "P%d" % (indicator % 5),
+                    "Humanitarian Action for Children Pillar": "Pillar %d" % (indicator % 5),
+                    "UNIT_MEASURE": "NUMBER",
+                    "Unit of measure": "Number",
+                    "TIME_PERIOD": timeperiod,
+                    "OBS_VALUE": str(i * 100 + indicator),
+                    "DATA_SOURCE": "Situation report",
+                    "TARGET": str(periods * 100),
+                    "OBS_STATUS": "A",
+                    "Observation status": "Normal value",
+                }
+                for column in extra:
+                    row[column] = "%s %s" % (column, countryiso)
+                yield row
+
+
+def headers_for(extra_columns=0):
+    return SDMX_HEADERS + ["EXTRA_%d" % i for i in range(extra_columns)]
+
+
+def write_csv(path, rows, headers):
+    """Write rows in dict form to a csv file."""
+    with open(path, "w", newline="", encoding="utf-8") as output:
+        writer = csv.DictWriter(output, fieldnames=headers)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def report_config(indicator, url):
+    """Return the report id and project configuration for a synthetic indicator, shaped like the real configuration."""
+    indicator_code = "CV-%02d-%02d" % (indicator // 10 + 1, indicator % 10 + 1)
+    report_id = indicator_code.replace("-", "_")
+    return report_id, {
+        "description": "Description of %s" % indicator_code,
+        "filename": "covid19sitrep%s" % indicator_code.replace("-", "").lower(),
+        "identifier": indicator_code,
+        "name": "Indicator %s" % indicator_code,
+        "url": url,
+        "observation_field": "Observation %s" % indicator_code,
+        "observation_field_hxl": "#indicator+value+num+%d" % indicator,
+        "target_field": "Target %s" % indicator_code,
+        "target_field_hxl": "#targeted+num+%d" % indicator,
+    }
+
+
+def write_reports(folder, countries=200, indicators=18, periods=24, extra_columns=0):
+    """
+    Write one synthetic SDMX csv per indicator to folder for real countries. Return the matching project
+    configuration in which each report url is the path of its csv.
+    """
+    codes = iso3_codes(countries)
+    headers = headers_for(extra_columns)
+    config = dict()
+    for indicator in range(indicators):
+        report_id, reportconfig = report_config(indicator, "")
+        path = join(folder, "%s.csv" % report_id)
+        write_csv(path, generate_rows(countries, 1, periods, extra_columns, indicator, codes), headers)
+        reportconfig["url"] = path
+        config[report_id] = reportconfig
+    return config
+
+
+def stub_hdx(countries):
+    """Set up a read only HDX configuration with the synthetic countries' locations (see tests.stub_hdx)."""
+    locations = [{"name": code.lower(), "title": code} for code in iso3_codes(countries)]
+    tests.stub_hdx(
+        locations + [{"name": "world", "title": "World"}], hdx_read_only=True, hdx_site="prod", user_agent="benchmark"
+    )
+
+
+class SyntheticDownloader:
+    """Stand-in for Download.get_tabular_rows serving synthetic situation reports from memory."""
+
+    def __init__(self, reports):
+        self.reports = reports
+
+    def get_tabular_rows(self, url, *args, dict_form=False, **kwargs):
+        headers, rows = self.reports[url]
+        if dict_form:
+            return headers, iter(rows)
+        return headers, ([row.get(header) for header in headers] for row in rows)
+
+    def close(self):
+        pass
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of generating the world dataset: processing all the rows again (joining them in memory) versus merging the
+csvs already written for each country. The rows are spooled to disk so that only the memory used to generate the
+world csvs is measured.
+
+Run from the repository root with: python -m benchmarks.world [--countries 200] [--indicators 18] [--periods 36]
+
+"""
+import argparse
+import gc
+import logging
+import tracemalloc
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from hdx.utilities.downloader import Download
+
+from benchmarks.synthetic import stub_hdx, write_reports
+from unicef import WORLD, RunMetadata, generate_dataset_and_showcase, get_all_countriesdata
+
+
+def measure(function, *args):
+    start = perf_counter()
+    function(*args)
+    elapsed = perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(countries, indicators, periods, extra_columns):
+    logging.getLogger().setLevel(logging.ERROR)
+    with TemporaryDirectory() as folder, TemporaryDirectory() as spool_folder, TemporaryDirectory() as output:
+        config = write_reports(folder, countries, indicators, periods, extra_columns)
+        stub_hdx(countries)
+        with Download(user_agent="benchmark") as downloader:
+            countrylist, countriesdata, headers = get_all_countriesdata(config, downloader, spool_folder=spool_folder)
+        qc_indicators = [{"code": reportconfig["identifier"]} for reportconfig in list(config.values())[:3]]
+        metadata = RunMetadata(config, qc_indicators, countrylist)
+        world = [country for country in countrylist if country["iso3"] == WORLD][0]
+        built = set()
+        for country in countrylist:
+            if country["iso3"] != WORLD:
+                generate_dataset_and_showcase(
+                    output, country, countriesdata[country["iso3"]], headers, config, qc_indicators, metadata=metadata
+                )
+                built.add(country["iso3"])
+        rows = sum(len(rows) for rows in countriesdata[WORLD].values())
+        print("%d rows, %d countries, %d reports" % (rows, len(built), indicators))
+        print("%-10s %10s %12s" % ("world", "seconds", "peak MiB"))
+        for name, merge_countries in (("in memory", None), ("merged", built)):
+            elapsed, peak = measure(
+                generate_dataset_and_showcase, output, world, countriesdata[WORLD], headers, config, qc_indicators,
+                "python", metadata, (), merge_countries
+            )
+            print("%-10s %10.3f %12.1f" % (name, elapsed, peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark world dataset generation")
+    parser.add_argument("--countries", type=int, default=200)
+    parser.add_argument("--indicators", type=int, default=18)
+    parser.add_argument("--periods", type=int, default=36)
+    parser.add_argument("--extra-columns", type=int, default=2)
+    args = parser.parse_args()
+    main(args.countries, args.indicators, args.periods, args.extra_columns)
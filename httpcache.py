@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Download cache:
+--------------
+
+On disk cache of downloaded files. Cached files are revalidated with conditional requests (ETag/Last-Modified) so
+that unchanged files are not transferred again. The cache is bounded in size with least recently used eviction.
+
+"""
+import hashlib
+import json
+import logging
+from os import makedirs, remove, replace
+from os.path import exists, getsize, join, splitext
+from threading import Lock
+from time import time
+from urllib.parse import parse_qs, urlsplit
+
+from instrumentation import count
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadCache(object):
+    """
+    Index of cached files kept in folder. The index can be shared between threads, each of which should wrap its own
+    downloader in a CachingDownloader.
+    """
+
+    index_filename = "index.json"
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = Lock()
+        self.full_transfers = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        makedirs(folder, exist_ok=True)
+        self.index_path = join(folder, self.index_filename)
+        try:
+            with open(self.index_path, encoding="utf-8") as input:
+                self.index = json.load(input)
+        except (OSError, ValueError):
+            self.index = dict()
+        for url, entry in list(self.index.items()):
+            if not exists(join(folder, entry["filename"])):
+                del self.index[url]
+
+    @staticmethod
+    def filename_for_url(url):
+        """Filename of cached file: hash of the url plus the extension of the url path or its format parameter."""
+        spliturl = urlsplit(url)
+        extension = splitext(spliturl.path)[1]
+        if not extension:
+            fileformat = parse_qs(spliturl.query).get("format")
+            if fileformat:
+                extension = ".%s" % fileformat[0]
+        return "%s%s" % (hashlib.sha1(url.encode("utf-8")).hexdigest(), extension)
+
+    def get(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            return dict(entry) if entry else None
+
+    def touch(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry:
+                entry["last_used"] = time()
+                self.save()
+
+    def put(self, url, entry):
+        with self.lock:
+            entry["last_used"] = time()
+            self.index[url] = entry
+            self.evict(url)
+            self.save()
+
+    def size(self):
+        return sum(entry["size"] for entry in self.index.values())
+
+    def evict(self, keep_url):
+        """Remove least recently used entries (except keep_url) until the cache fits within max_size."""
+        total = self.size()
+        for url, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_size:
+                break
+            if url == keep_url:
+                continue
+            logger.info("Evicting %s from download cache" % url)
+            try:
+                remove(join(self.folder, entry["filename"]))
+            except OSError:
+                pass
+            total -= entry["size"]
+            del self.index[url]
+
+    def save(self):
+        temp_path = "%s.tmp" % self.index_path
+        with open(temp_path, "w", encoding="utf-8") as output:
+            json.dump(self.index, output)
+        replace(temp_path, self.index_path)
+
+
+class CachingDownloader(object):
+    """Wraps a Download object so that get_tabular_rows reads from the download cache."""
+
+    def __init__(self, downloader, cache):
+        self.downloader = downloader
+        self.cache = cache
+
+    def fetch(self, url, timeout=None):
+        """Return path of an up to date cached copy of url, downloading it only if it changed."""
+        cache = self.cache
+        entry = cache.get(url)
+        filename = DownloadCache.filename_for_url(url)
+        path = join(cache.folder, filename)
+        requestheaders = dict()
+        if entry:
+            if entry.get("etag"):
+                requestheaders["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                requestheaders["If-Modified-Since"] = entry["last_modified"]
+        response = self.downloader.setup(url, timeout=timeout, headers=requestheaders)
+        try:
+            if entry and response.status_code == 304:
+                logger.info("%s not modified. Using cached copy" % url)
+                with cache.lock:
+                    cache.not_modified += 1
+                cache.touch(url)
+                return path
+            sha256 = hashlib.sha256()
+            temp_path = "%s.part" % path
+            size = 0
+            with open(temp_path, "wb") as output:
+                for chunk in response.iter_content(chunk_size=65536):
+                    if chunk:
+                        sha256.update(chunk)
+                        output.write(chunk)
+                        size += len(chunk)
+        finally:
+            self.downloader.close_response()
+        count("bytes_downloaded", size)
+        with cache.lock:
+            cache.full_transfers += 1
+        contenthash = sha256.hexdigest()
+        if entry and entry["sha256"] == contenthash:
+            logger.info("%s unchanged. Using cached copy" % url)
+            remove(temp_path)
+            with cache.lock:
+                cache.unchanged += 1
+        else:
+            replace(temp_path, path)
+        cache.put(
+            url,
+            {
+                "filename": filename,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "sha256": contenthash,
+                "size": getsize(path),
+            },
+        )
+        return path
+
+    def get_tabular_rows(self, url, *args, **kwargs):
+        path = self.fetch(url, timeout=kwargs.pop("http_timeout", None))
+        return self.downloader.get_tabular_rows(path, *args, **kwargs)
+
+    def close(self):
+        self.downloader.close()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Instrumentation:
+---------------
+
+Timers and counters around the stages of a run (downloading, grouping, writing csvs, generating resource views,
+calling the HDX API), totalled per stage and per country and reported at the end of the run.
+
+A stage can be profiled by listing it in the UNICEFSAM_PROFILE environment variable eg.
+UNICEFSAM_PROFILE=download,write_csv. Profiles are written to the temporary folder using cProfile, or pyinstrument
+if it is installed and UNICEFSAM_PROFILER=pyinstrument.
+
+"""
+import cProfile
+import json
+import logging
+from contextlib import contextmanager
+from functools import wraps
+from os import getenv
+from os.path import join
+from threading import Lock, local
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_STAGES = {stage.strip() for stage in getenv("UNICEFSAM_PROFILE", "").split(",") if stage.strip()}
+PROFILER = getenv("UNICEFSAM_PROFILER", "cprofile")
+
+
+class Metrics(object):
+    """Thread safe totals of the time spent in each stage and of counters, overall and per country."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stages = dict()
+        self.counters = dict()
+        self.countries = dict()
+
+    def country(self, countryiso):
+        countrymetrics = self.countries.get(countryiso)
+        if countrymetrics is None:
+            countrymetrics = self.countries[countryiso] = {"seconds": dict(), "counters": dict()}
+        return countrymetrics
+
+    def add_time(self, stage, seconds, country=None, calls=1):
+        with self.lock:
+            totals = self.stages.get(stage)
+            if totals is None:
+                totals = self.stages[stage] = {"calls": 0, "seconds": 0.0}
+            totals["calls"] += calls
+            totals["seconds"] += seconds
+            if country:
+                countryseconds = self.country(country)["seconds"]
+                countryseconds[stage] = countryseconds.get(stage, 0.0) + seconds
+
+    def count(self, name, value=1, country=None):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if country:
+                countrycounters = self.country(country)["counters"]
+                countrycounters[name] = countrycounters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, stage, country=None):
+        with profile(stage, country):
+            start = perf_counter()
+            try:
+                yield
+            finally:
+                self.add_time(stage, perf_counter() - start, country)
+
+    def report(self):
+        """Plain (picklable and JSON serialisable) copy of the metrics."""
+        with self.lock:
+            return json.loads(json.dumps({"stages": self.stages, "counters": self.counters,
+                                          "countries": self.countries}))
+
+    def merge(self, report):
+        """Add the metrics from report (as returned by report, eg. from a worker process) to these metrics."""
+        for stage, totals in report["stages"].items():
+            self.add_time(stage, totals["seconds"], calls=totals["calls"])
+        for name, value in report["counters"].items():
+            self.count(name, value)
+        with self.lock:
+            for countryiso, countrymetrics in report["countries"].items():
+                ownmetrics = self.country(countryiso)
+                for key in ("seconds", "counters"):
+                    for name, value in countrymetrics[key].items():
+                        ownmetrics[key][name] = ownmetrics[key].get(name, 0) + value
+
+    def write_report(self, path):
+        with open(path, "w", encoding="utf-8") as output:
+            json.dump(self.report(), output, indent=1, sort_keys=True)
+
+    def log_summary(self, slowest=5):
+        report = self.report()
+        logger.info("%-24s %8s %12s" % ("Stage", "Calls", "Seconds"))
+        for stage, totals in sorted(report["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            logger.info("%-24s %8d %12.2f" % (stage, totals["calls"], totals["seconds"]))
+        for name, value in sorted(report["counters"].items()):
+            logger.info("%-24s %21d" % (name, value))
+        countrytotals = sorted(
+            ((sum(countrymetrics["seconds"].values()), countryiso)
+             for countryiso, countrymetrics in report["countries"].items()), reverse=True)
+        for seconds, countryiso in countrytotals[:slowest]:
+            logger.info("Slowest country %s: %.2fs" % (countryiso, seconds))
+
+
+metrics = Metrics()
+captured = local()
+
+
+def current():
+    """Metrics that records go to: those of the innermost capture in this thread, otherwise the run's metrics."""
+    return getattr(captured, "metrics", None) or metrics
+
+
+@contextmanager
+def capture():
+    """Send the records made in this thread to new metrics, eg. to return them from a worker process to be merged."""
+    previous = getattr(captured, "metrics", None)
+    captured.metrics = Metrics()
+    try:
+        yield captured.metrics
+    finally:
+        captured.metrics = previous
+
+
+def timer(stage, country=None):
+    """Context manager timing a stage."""
+    return current().timer(stage, country)
+
+
+def count(name, value=1, country=None):
+    current().count(name, value, country)
+
+
+def timed(stage):
+    """Decorator timing each call of a function as a stage."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_time(stage, seconds, country=None):
+    current().add_time(stage, seconds, country)
+
+
+class TimedIterator(object):
+    """Wraps an iterator, totalling the time spent producing its items (eg. downloading and parsing rows)."""
+
+    def __init__(self, iterator):
+        self.iterator = iter(iterator)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = perf_counter()
+        try:
+            return next(self.iterator)
+        finally:
+            self.seconds += perf_counter() - start
+
+
+@contextmanager
+def profile(stage, country=None):
+    """Profile the enclosed code if the stage is listed in UNICEFSAM_PROFILE."""
+    if stage not in PROFILE_STAGES:
+        yield
+        return
+    name = "UNICEFSAM_profile_%s" % stage
+    if country:
+        name = "%s_%s" % (name, country)
+    from hdx.utilities.path import get_temp_dir
+
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        Profiler = None
+    if PROFILER == "pyinstrument" and Profiler is not None:
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            path = join(get_temp_dir(), "%s.txt" % name)
+            with open(path, "w", encoding="utf-8") as output:
+                output.write(profiler.output_text())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = join(get_temp_dir(), "%s.prof" % name)
+            profiler.dump_stats(path)
+    logger.info("Profile of %s written to %s" % (stage, path))
@@ -1,13 +1,70 @@
-from liquer import *
-import pandas as pd
+"""
+Profiling of the situation report indicators: the number of distinct values (and first value) of every column of
+each indicator's data, plus a project configuration for all the indicators in the UNICEF codelist.
+
+Run from the repository root with: python -m misc.analysis [--folder sitreps] [--offline] [--workers 8]
+
+Indicators are fetched concurrently through the scraper's download cache and saved to folder as <identifier>.csv
+(and the codelist as codelist.xml). With --offline, nothing is downloaded and the files saved in folder are read.
+
+"""
+import argparse
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from glob import glob
+from os import makedirs
+from os.path import exists, join
+from shutil import copyfile
+
+import pandas as pd
+from liquer import *
 from lxml import etree
-from urllib.request import urlopen
-from liquer.ext.lq_pandas import df_from
 
 DATA_FOLDER = "out/"
 FILENAME_PREFIX = "covid19sitrep_"
+CODELIST_URL = "https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/codelist/UNICEF.EMOPS/CL_EMOPS_INDICATORS/1.0"
+SITREP_URL = "https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.%s?format=csv"
+CACHE_SIZE = 500000000
+
+# Set from the command line: folder of saved files, whether to only read saved files and number of concurrent fetches
+settings = {"folder": "sitreps", "offline": False, "workers": 8}
+
+
+@lru_cache(maxsize=None)
+def download_cache():
+    """The scraper's download cache, so that indicators already downloaded are only revalidated."""
+    from hdx.utilities.path import get_temp_dir
+
+    from httpcache import DownloadCache
+
+    return DownloadCache(get_temp_dir("UNICEFSAM_httpcache"), CACHE_SIZE)
+
+
+def saved_file(url, filename):
+    """
+    Path of the copy of url saved as filename in the folder. Unless offline, url is fetched (through the download
+    cache) and saved first.
+    """
+    path = join(settings["folder"], filename)
+    if settings["offline"]:
+        if not exists(path):
+            raise FileNotFoundError("%s has not been saved. Run without --offline first" % path)
+        return path
+    from hdx.utilities.downloader import Download
+
+    from httpcache import CachingDownloader
+
+    print(f"Read {url}")
+    with Download(user_agent="UNICEFSAM-analysis") as downloader:
+        cachedpath = CachingDownloader(downloader, download_cache()).fetch(url)
+    makedirs(settings["folder"], exist_ok=True)
+    copyfile(cachedpath, path)
+    return path
+
+
+def read_sitrep(identifier):
+    return pd.read_csv(saved_file(SITREP_URL % identifier, "%s.csv" % identifier))
 
 
 @first_command
@@ -29,55 +86,49 @@ def all_countries():
 
 @first_command
 def unicef_codes_xml():
-    return urlopen(
-        "https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/codelist/UNICEF.EMOPS/CL_EMOPS_INDICATORS/1.0"
-    ).read()
+    with open(saved_file(CODELIST_URL, "codelist.xml"), "rb") as input:
+        return input.read()
 
 
 @command
 def unicef_codes_df(xml):
-    df = pd.DataFrame(columns=["identifier", "text", "urn"])
     root = etree.fromstring(xml)
-    for x in root.xpath("//*[local-name() = 'Code']"):
-        df = df.append(
-            dict(
-                urn=x.attrib["urn"],
-                identifier=x.attrib["id"],
-                text="".join(xx.text for xx in x),
-            ),
-            ignore_index=True,
-        )
-        # print(x, x.tag, x.attrib["urn"], x.attrib["id"], "".join(xx.text for xx in x))
-    return df
+    records = [
+        dict(identifier=x.attrib["id"], text="".join(xx.text for xx in x), urn=x.attrib["urn"])
+        for x in root.xpath("//*[local-name() = 'Code']")
+    ]
+    return pd.DataFrame.from_records(records, columns=["identifier", "text", "urn"])
 
 
 @first_command
 def sitrep(*code):
-    c = "-".join(code)
-    url = f"https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.{c}?format=csv"
-    print(f"Read situational report from {url}")
-    return df_from(url, "csv").get()
+    return read_sitrep("-".join(code))
 
 
 @command
 def unique_count(df):
+    counts = df.nunique(dropna=False)
+    first = df.iloc[0] if len(df) else pd.Series(None, index=df.columns, dtype=object)
     d = {}
     for c in df.columns:
-        v = list(df[c].unique())
-        d[f"{c}_count"] = len(v)
-        d[f"{c}_value"] = v[0]
+        d[f"{c}_count"] = int(counts[c])
+        d[f"{c}_value"] = first[c]
     return d
 
 
 @command
 def unique_stat(df):
-    data = []
-    for i, row in df.iterrows():
-        d = unique_count(sitrep(row.identifier))
-        d["identifier"] = row.identifier
-        d["text"] = row.text
-        data.append(d)
-    return pd.DataFrame(data)
+    if not settings["offline"]:
+        download_cache()  # shared by the fetching threads
+    with ThreadPoolExecutor(max_workers=settings["workers"]) as executor:
+        sitreps = executor.map(read_sitrep, df.identifier)
+        data = []
+        for identifier, text, sitrep_df in zip(df.identifier, df.text, sitreps):
+            d = unique_count(sitrep_df)
+            d["identifier"] = identifier
+            d["text"] = text
+            data.append(d)
+    return pd.DataFrame.from_records(data)
 
 
 @command
@@ -85,10 +136,9 @@ def config_yaml(df):
     import yaml
 
     d = {}
-    for i, row in df.iterrows():
-        url = f"https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.{row.identifier}?format=csv"
-        dd = dict(row)
-        dd["url"] = url
+    for row in df.itertuples(index=False):
+        dd = dict(row._asdict())
+        dd["url"] = SITREP_URL % row.identifier
         dd["filename"] = "covid19sitrep_" + row.identifier.replace("-", "_")
         dd["name"] = row.text
         dd["description"] = row.text
@@ -98,10 +148,12 @@ def config_yaml(df):
 
 
 if __name__ == "__main__":
-    df = evaluate("unicef_codes_xml/unicef_codes_df").get()
-    #    for i, row in df.iterrows():
-    #        print(row.text)
-    #        evaluate_and_save(f"sitrep-{row.identifier}/{row.identifier.replace('-','_')}.xlsx")
+    parser = argparse.ArgumentParser(description="Profile the situation report indicators")
+    parser.add_argument("--folder", default=settings["folder"], help="Folder of saved indicator csvs")
+    parser.add_argument("--offline", action="store_true", help="Read the saved files instead of downloading")
+    parser.add_argument("--workers", type=int, default=settings["workers"], help="Concurrent indicator fetches")
+    args = parser.parse_args()
+    settings.update(folder=args.folder, offline=args.offline, workers=args.workers)
 
     evaluate_and_save(
         f"unicef_codes_xml/unicef_codes_df/config_yaml/project_configuration.yml"
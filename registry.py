@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Indicator registry:
+------------------
+
+The situation reports of the project configuration compiled once per configuration file. Compiling validates each
+report so that a missing filename or url, or half an HXL pair, fails at start up rather than part way through a run,
+and works out each report's url, joined field mappings and HXL hashtags for direct lookup. The compiled registry is
+cached as JSON named after the hash of the configuration file, so the YAML is only parsed when the file changes. The
+cache is data only: a tampered cache file cannot run code.
+
+"""
+import hashlib
+import json
+import logging
+from collections.abc import Mapping
+from os import replace
+from os.path import exists, join
+from tempfile import mkstemp
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever what is compiled changes, so that registries cached by older code are not used
+REGISTRY_VERSION = 1
+REQUIRED_FIELDS = ("filename", "url")
+# Configuration field of a value that a report contributes to the joined data and the report's column holding it
+FIELD_TYPES = (("observation_field", "OBS_VALUE"), ("target_field", "TARGET"))
+
+
+class RegistryError(ValueError):
+    """The project configuration has invalid situation reports."""
+
+
+def report_field_mappings(report_config):
+    """List of (destination field, source field) pairs that a report contributes to the joined data."""
+    return [
+        (report_config[field_type], source_field)
+        for field_type, source_field in FIELD_TYPES
+        if field_type in report_config
+    ]
+
+
+def report_errors(report_id, report_config):
+    """Problems with a report's configuration (empty if there are none)."""
+    errors = ["%s has no %s" % (report_id, field) for field in REQUIRED_FIELDS if not report_config.get(field)]
+    for field_type, _ in FIELD_TYPES:
+        field_hxl = "%s_hxl" % field_type
+        if field_type in report_config and field_hxl not in report_config:
+            errors.append("%s has %s but no %s" % (report_id, field_type, field_hxl))
+        elif field_hxl in report_config and field_type not in report_config:
+            errors.append("%s has %s but no %s" % (report_id, field_hxl, field_type))
+    return errors
+
+
+class IndicatorRegistry(Mapping):
+    """
+    Read only mapping of report id to report configuration (the entries of the project configuration that are
+    mappings) with each report's url, field mappings and HXL hashtags worked out once. It can be passed wherever the
+    report configurations are expected. The other entries of the project configuration are in settings.
+    """
+
+    __slots__ = ("reports", "settings", "urls", "field_mappings", "hxltags")
+
+    def __init__(self, config):
+        # Plain dictionaries and lists (not the YAML loader's types) that pickle and serialise to JSON
+        config = json.loads(json.dumps(config))
+        reports = {key: value for key, value in config.items() if isinstance(value, dict)}
+        errors = [error for report_id, report_config in reports.items()
+                  for error in report_errors(report_id, report_config)]
+        if errors:
+            raise RegistryError("Invalid project configuration: %s" % "; ".join(errors))
+        hxltags = dict()
+        for report_config in reports.values():
+            for field_type, _ in FIELD_TYPES:
+                if field_type in report_config:
+                    hxltags[report_config[field_type]] = report_config["%s_hxl" % field_type]
+        self._set(
+            reports=reports,
+            settings={key: value for key, value in config.items() if key not in reports},
+            urls={report_id: report_config["url"] for report_id, report_config in reports.items()},
+            field_mappings={
+                report_id: tuple(report_field_mappings(report_config)) for report_id, report_config in reports.items()
+            },
+            hxltags=hxltags,
+        )
+
+    def _set(self, **attributes):
+        for name, value in attributes.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("IndicatorRegistry is read only")
+
+    def __delattr__(self, name):
+        raise AttributeError("IndicatorRegistry is read only")
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        self._set(**state)
+
+    def to_json(self):
+        """The compiled registry as JSON, read back by from_json."""
+        return json.dumps(self.__getstate__())
+
+    @classmethod
+    def from_json(cls, text):
+        """IndicatorRegistry from the output of to_json, without compiling the configuration again."""
+        state = json.loads(text)
+        if sorted(state) != sorted(cls.__slots__):
+            raise ValueError("Not an indicator registry")
+        state["field_mappings"] = {
+            report_id: tuple(tuple(mapping) for mapping in mappings)
+            for report_id, mappings in state["field_mappings"].items()
+        }
+        registry = cls.__new__(cls)
+        registry.__setstate__(state)
+        return registry
+
+    def __getitem__(self, report_id):
+        return self.reports[report_id]
+
+    def __iter__(self):
+        return iter(self.reports)
+
+    def __len__(self):
+        return len(self.reports)
+
+    def __repr__(self):
+        return "IndicatorRegistry(%d reports)" % len(self.reports)
+
+
+def field_mappings(config, report_id):
+    """A report's (destination field, source field) pairs, looked up directly if config is an IndicatorRegistry."""
+    if isinstance(config, IndicatorRegistry):
+        return config.field_mappings.get(report_id, ())
+    return report_field_mappings(config.get(report_id, {}))
+
+
+def load_registry(path, cache_folder=None):
+    """
+    IndicatorRegistry of the project configuration file at path. It is read from the JSON cached in cache_folder
+    (the temporary folder by default) for the file's contents if there is one, otherwise compiled from the YAML and
+    cached. Raises RegistryError if the configuration is invalid.
+    """
+    with open(path, "rb") as input:
+        digest = hashlib.sha256(input.read())
+    digest.update(str(REGISTRY_VERSION).encode("utf-8"))
+    if cache_folder is None:
+        from hdx.utilities.path import get_temp_dir
+
+        cache_folder = get_temp_dir()
+    cache_path = join(cache_folder, "UNICEFSAM_registry_%s.json" % digest.hexdigest())
+    if exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as input:
+                return IndicatorRegistry.from_json(input.read())
+        except Exception as ex:
+            logger.warning("Could not read cached indicator registry %s (%s). Compiling it again" % (cache_path, ex))
+    from hdx.utilities.loader import load_yaml
+
+    registry = IndicatorRegistry(load_yaml(path))
+    # A new file rather than a fixed name so that nothing already at the path (eg. a link) is written to
+    fd, temp_path = mkstemp(suffix=".tmp", dir=cache_folder)
+    with open(fd, "w", encoding="utf-8") as output:
+        output.write(registry.to_json())
+    replace(temp_path, cache_path)
+    logger.info("Compiled indicator registry of %d reports from %s" % (len(registry), path))
+    return registry
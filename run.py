@@ -4,16 +4,32 @@
 Top level script. Calls other functions that generate datasets that this script then creates in HDX.
 
 """
+import argparse
+import json
 import logging
-from os.path import join, expanduser
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import partial
+from os import replace
+from os.path import exists, join, expanduser
+from threading import Event, Lock
+from time import monotonic, perf_counter, sleep
 
-from hdx.hdx_configuration import Configuration
-from hdx.utilities.downloader import Download
-from hdx.utilities.path import progress_storing_tempdir
+from httpcache import CachingDownloader, DownloadCache
+from instrumentation import count, metrics, timer
+from registry import load_registry
+from store import ObservationStore
+from unicef import (
+    WORLD,
+    QuickChartsIndex,
+    RunMetadata,
+    build_dataset_and_showcase,
+    country_fingerprint,
+    get_all_countriesdata,
+    restore_dataset_and_showcase,
+)
 
-from unicef import generate_dataset_and_showcase, get_all_countriesdata
-
-from hdx.facades.simple import facade
+# The hdx modules are imported where first used to keep startup fast. A dry run never imports the HDX client
+# (hdx.hdx_configuration, hdx.data and hdx.facades).
 
 logger = logging.getLogger(__name__)
 
@@ -21,39 +37,317 @@ logger = logging.getLogger(__name__)
 lookup = "hdx-scraper-unicef-sam"
 
 
-def main():
-    """Generate dataset and create it in HDX"""
+def load_fingerprints(path):
+    if not exists(path):
+        return dict()
+    with open(path, encoding="utf-8") as input:
+        return json.load(input)
+
+
+def save_fingerprints(path, fingerprints):
+    temp_path = "%s.tmp" % path
+    with open(temp_path, "w", encoding="utf-8") as output:
+        json.dump(fingerprints, output, indent=1, sort_keys=True)
+    replace(temp_path, path)
+
+
+class RateLimiter(object):
+    """Spaces out calls across threads so that at most calls_per_second start each second (no limit if falsy)."""
+
+    def __init__(self, calls_per_second):
+        self.interval = 1.0 / calls_per_second if calls_per_second else 0
+        self.lock = Lock()
+        self.next_call = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = monotonic()
+            wait = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if wait > 0:
+            sleep(wait)
+
+
+def call_hdx(call, countryiso, limiter):
+    with timer("rate_limit_wait", countryiso):
+        limiter.wait()
+    with timer("hdx_api", countryiso):
+        call()
+    count("api_calls", 1, countryiso)
+
+
+def upload(build, countryiso, batch, qc_indicators, limiter, showcasers):
+    """
+    Wait for a country's dataset to be built then create it in HDX with its resource files in one request tagged with
+    batch, leaving the showcase to showcasers. Returns whether a dataset was uploaded, the build and upload times and
+    the future of the showcase upload (None if nothing was uploaded).
+    """
+    built, build_time, buildmetrics = build.result()
+    metrics.merge(buildmetrics)
+    if built is None:
+        return False, build_time, 0, None
+    start = perf_counter()
+    dataset, showcase, bites_disabled = restore_dataset_and_showcase(built)
+    dataset.update_from_yaml()
+    with timer("resource_views", countryiso):
+        dataset.generate_resource_view(1, bites_disabled=bites_disabled, indicators=qc_indicators)
+    call_hdx(
+        partial(
+            dataset.create_in_hdx,
+            remove_additional_resources=True,
+            hxl_update=False,
+            updated_by_script="HDX Scraper: UNICEF Sam",
+            batch=batch,
+        ),
+        countryiso,
+        limiter,
+    )
+    return True, build_time, perf_counter() - start, showcasers.submit(
+        upload_showcase, dataset, showcase, countryiso, limiter
+    )
+
+
+def upload_showcase(dataset, showcase, countryiso, limiter):
+    """Create a country's showcase in HDX and link it to the dataset. Returns the time taken."""
+    start = perf_counter()
+    call_hdx(showcase.create_in_hdx, countryiso, limiter)
+    call_hdx(partial(showcase.add_dataset, dataset), countryiso, limiter)
+    return perf_counter() - start
+
 
-    with Download() as downloader:
-        config=Configuration.read()
-        project_config = {key:value for key,value in config.items() if key.startswith("CV")}
-        qc_indicators = config.get("qc_indicators",{})
+def build_world(builders, builds, stop, *args, **kwargs):
+    """
+    Wait for the country datasets to be built then build the world dataset in builders, merging its csvs from those
+    of the countries that were built (see merge_world_files). Raises CancelledError if stop (an Event) is set.
+    """
+    wait(list(builds.values()))
+    if stop.is_set():
+        raise CancelledError()
+    merge_countries = {
+        countryiso for countryiso, build in builds.items() if build.exception() is None and build.result()[0] is not None
+    }
+    return builders.submit(build_dataset_and_showcase, *args, merge_countries, **kwargs).result()
+
+
+def caching_downloader(factory, cache):
+    """Downloader from factory whose downloads go through cache (a DownloadCache)."""
+    return CachingDownloader(factory(), cache)
+
+
+def shutdown_now(executor):
+    """Shut executor down without waiting, cancelling the futures not yet started (Python 3.9+)."""
+    try:
+        executor.shutdown(wait=False, cancel_futures=True)
+    except TypeError:
+        executor.shutdown(wait=False)
+
+
+def fetch_all(registry, downloader, partitions_folder):
+    """
+    Fetch the situation reports in registry (an IndicatorRegistry) and split them by country. Returns the report
+    configurations (the registry) too and the QuickChartsIndex of the QuickCharts rows collected while fetching.
+    """
+    from hdx.utilities.downloader import Download
+    from hdx.utilities.path import get_temp_dir
+
+    config = registry.settings
+    qc_indicators = config.get("qc_indicators", {})
+    qc_index = QuickChartsIndex(x["code"] for x in qc_indicators)
+    if config.get("streaming", False):
+        logger.info("Streaming mode: spooling rows to per-country partitions in %s" % partitions_folder)
+        spool_folder = partitions_folder
+    else:
+        spool_folder = None
+    store = None
+    store_filename = config.get("observation_store")
+    if store_filename:
+        store = ObservationStore(join(get_temp_dir(), store_filename))
+        logger.info("Storing observations in %s" % store.path)
+    cache_size = config.get("http_cache_size")
+    if cache_size:
+        cache = DownloadCache(get_temp_dir("UNICEFSAM_httpcache"), cache_size)
+        downloader = CachingDownloader(downloader, cache)
+        downloader_factory = partial(caching_downloader, Download, cache)
+    else:
+        downloader_factory = Download
+    try:
         countries, countriesdata, headers = get_all_countriesdata(
-                project_config, downloader
-            )
+            registry,
+            downloader,
+            fetch_workers=config.get("fetch_workers", 1),
+            timeout=config.get("fetch_timeout"),
+            retries=config.get("fetch_retries", 0),
+            backoff=config.get("fetch_backoff", 1),
+            downloader_factory=downloader_factory,
+            spool_folder=spool_folder,
+            store=store,
+            incremental=config.get("incremental_fetch"),
+            full_fetch_days=config.get("full_fetch_days"),
+            batch_url_length=config.get("batch_url_length"),
+            qc_index=qc_index,
+        )
+    finally:
+        if store:
+            store.close()
+    if cache_size:
+        logger.info("Download cache: %d full transfers (%d unchanged), %d not modified" % (
+            cache.full_transfers, cache.unchanged, cache.not_modified))
+    return registry, qc_indicators, countries, countriesdata, headers, qc_index
+
 
+def dry_run(project_config_yaml):
+    """
+    Fetch and partition the data and log which countries would be uploaded, without touching HDX. The HDX client
+    modules are not imported, so no HDX configuration is needed.
+    """
+    from hdx.utilities.downloader import Download
+    from hdx.utilities.path import get_temp_dir, temp_dir
+
+    registry = load_registry(project_config_yaml)
+    output_formats = registry.settings.get("output_formats")
+    with Download() as downloader, temp_dir("UNICEFSAM_partitions", delete_if_exists=True) as partitions_folder:
+        project_config, qc_indicators, countries, countriesdata, headers, _ = fetch_all(
+            registry, downloader, partitions_folder
+        )
+        fingerprints = load_fingerprints(join(get_temp_dir(), "UNICEFSAM_fingerprints.json"))
+        changed = 0
+        for country in countries:
+            countryiso = country["iso3"]
+            countrydata = countriesdata[countryiso]
+            rows = sum(len(report_rows) for report_rows in countrydata.values())
+            fingerprint = country_fingerprint(countrydata, headers, project_config, qc_indicators, output_formats)
+            if fingerprints.get(countryiso) == fingerprint:
+                status = "unchanged"
+            else:
+                status = "would upload"
+                changed += 1
+            logger.info("%s: %d rows in %d reports, %s" % (country["name"], rows, len(countrydata), status))
+    logger.info("Dry run: %d of %d countries would be uploaded" % (changed, len(countries)))
+
+
+def main(project_config_yaml, force=False):
+    """Generate dataset and create it in HDX"""
+    from hdx.utilities.downloader import Download
+    from hdx.utilities.path import get_temp_dir, progress_storing_tempdir, temp_dir
+
+    # The project configuration is read from the registry (compiled once per version of the file), not from the HDX
+    # configuration
+    registry = load_registry(project_config_yaml)
+    config = registry.settings
+    with Download() as downloader, temp_dir("UNICEFSAM_partitions", delete_if_exists=True) as partitions_folder:
+        project_config, qc_indicators, countries, countriesdata, headers, qc_index = fetch_all(
+            registry, downloader, partitions_folder
+        )
+
+        # Fingerprints of the last successful uploads live next to (not in) the progress_storing_tempdir folder,
+        # which is deleted at the end of each complete run
+        fingerprints_path = join(get_temp_dir(), "UNICEFSAM_fingerprints.json")
+        fingerprints = load_fingerprints(fingerprints_path)
+        # Country datasets are built in a process pool and uploaded through a thread pool, with showcases created
+        # in another thread pool. Progress only advances once a country's dataset and showcase uploads have finished,
+        # and in country order, so an interrupted run resumes at the first country that was not uploaded
+        build_workers = config.get("build_workers", 1)
+        upload_workers = config.get("upload_workers", 1)
+        limiter = RateLimiter(config.get("upload_calls_per_second"))
+        join_engine = config.get("join_engine", "python")
+        output_formats = config.get("output_formats")
+        metadata = RunMetadata(project_config, qc_indicators, countries)
+        skipped = 0
+        build_time = upload_time = 0.0
+        start = perf_counter()
+        pending = None
+        builds = dict()
+        world = None
+        stop = Event()
         logger.info("Number of datasets to upload: %d" % len(countries))
-        for info, country in progress_storing_tempdir("UNICEFSAM", countries, "iso3"):
-            dataset, showcase, bites_disabled = generate_dataset_and_showcase(
-                info["folder"], country, countriesdata[country["iso3"]], headers, project_config, qc_indicators
-            )
-            if dataset:
-                dataset.update_from_yaml()
-                dataset.generate_resource_view(1, bites_disabled=bites_disabled, indicators=qc_indicators)
-                dataset.create_in_hdx(
-                    remove_additional_resources=True,
-                    hxl_update=False,
-                    updated_by_script="HDX Scraper: UNICEF Sam",
-                    batch=info["batch"],
-                )
-                showcase.create_in_hdx()
-                showcase.add_dataset(dataset)
+        with ProcessPoolExecutor(max_workers=build_workers) as builders, \
+                ThreadPoolExecutor(max_workers=upload_workers) as showcasers, \
+                ThreadPoolExecutor(max_workers=upload_workers) as uploaders:
+            try:
+                for info, country in progress_storing_tempdir("UNICEFSAM", countries, "iso3"):
+                    if pending is None:
+                        pending = dict()
+                        for remaining in countries[countries.index(country):]:
+                            countryiso = remaining["iso3"]
+                            countrydata = countriesdata[countryiso]
+                            fingerprint = country_fingerprint(
+                                countrydata, headers, project_config, qc_indicators, output_formats
+                            )
+                            if not force and fingerprints.get(countryiso) == fingerprint:
+                                pending[countryiso] = None
+                                continue
+                            args = (info["folder"], remaining, countrydata, headers, project_config, qc_indicators,
+                                    join_engine, metadata, output_formats)
+                            country_qc_index = qc_index.country(countryiso)
+                            if countryiso == WORLD:
+                                # Runs in an upload thread as it waits for the other builds
+                                build = world = uploaders.submit(
+                                    build_world, builders, dict(builds), stop, *args, qc_index=country_qc_index
+                                )
+                            else:
+                                build = builds[countryiso] = builders.submit(
+                                    build_dataset_and_showcase, *args, qc_index=country_qc_index
+                                )
+                            pending[countryiso] = fingerprint, uploaders.submit(
+                                upload, build, countryiso, info["batch"], qc_indicators, limiter, showcasers
+                            )
+                    countryiso = country["iso3"]
+                    scheduled = pending.pop(countryiso)
+                    if scheduled is None:
+                        logger.info("Skipping %s: unchanged since last upload" % country["name"])
+                        skipped += 1
+                        continue
+                    fingerprint, future = scheduled
+                    uploaded, country_build_time, country_upload_time, showcase_upload = future.result()
+                    if showcase_upload is not None:
+                        country_upload_time += showcase_upload.result()
+                    build_time += country_build_time
+                    upload_time += country_upload_time
+                    logger.info("%s: build %.2fs, upload %.2fs" % (country["name"], country_build_time, country_upload_time))
+                    if uploaded:
+                        fingerprints[countryiso] = fingerprint
+                        save_fingerprints(fingerprints_path, fingerprints)
+            except BaseException:
+                # Stop building and uploading the remaining countries and the world before raising
+                stop.set()
+                futures = [scheduled[1] for scheduled in (pending or {}).values() if scheduled is not None]
+                for future in futures + list(builds.values()) + ([world] if world else []):
+                    future.cancel()
+                for executor in (builders, uploaders, showcasers):
+                    shutdown_now(executor)
+                raise
+        logger.info("Skipped %d of %d countries unchanged since last upload" % (skipped, len(countries)))
+        logger.info("Build: %.1fs over %d workers. Upload: %.1fs over %d workers. Total elapsed: %.1fs" % (
+            build_time, build_workers, upload_time, upload_workers, perf_counter() - start))
+        metrics_path = join(get_temp_dir(), "UNICEFSAM_metrics.json")
+        metrics.write_report(metrics_path)
+        logger.info("Stage timings and counters written to %s" % metrics_path)
+        metrics.log_summary()
 
 
 if __name__ == "__main__":
-    facade(
-        main,
-        user_agent_config_yaml=join(expanduser("~"), ".useragents.yml"),
-        user_agent_lookup=lookup,
-        project_config_yaml=join("config", "project_configuration.yml"),
+    parser = argparse.ArgumentParser(description="UNICEF COVID-19 situation report scraper")
+    parser.add_argument("--force", action="store_true", help="Upload all countries even if unchanged")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Fetch and partition the data without touching HDX"
     )
+    args = parser.parse_args()
+    user_agent_config_yaml = join(expanduser("~"), ".useragents.yml")
+    project_config_yaml = join("config", "project_configuration.yml")
+    if args.dry_run:
+        from hdx.utilities.easy_logging import setup_logging
+        from hdx.utilities.useragent import UserAgent
+
+        setup_logging()
+        UserAgent.set_global(user_agent_config_yaml=user_agent_config_yaml, user_agent_lookup=lookup)
+        dry_run(project_config_yaml)
+    else:
+        from hdx.facades.simple import facade
+
+        facade(
+            partial(main, project_config_yaml, force=args.force),
+            user_agent_config_yaml=user_agent_config_yaml,
+            user_agent_lookup=lookup,
+        )
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Observation store:
+-----------------
+
+SQLite store of every situation report observation downloaded, kept between runs. Country datasets are generated
+from queries against the store and it can be queried for analysis without going to the network.
+
+"""
+import json
+import logging
+import sqlite3
+from contextlib import closing
+
+from unicef import WORLD, WorldView, compact_rows
+
+logger = logging.getLogger(__name__)
+
+# Columns of the SDMX dimensions of an observation, stored in their own columns for queries
+KEY_FIELDS = ["REF_AREA", "SITREP_INDICATOR", "TIME_PERIOD"]
+# Columns of an observation's measures. Every other column (eg. DATA_SOURCE) is part of its key with KEY_FIELDS, as in
+# the downloaded data, so that a stored report has the same rows as a download. Observations with the same key are
+# upserted
+MEASURE_FIELDS = ("OBS_VALUE", "TARGET")
+# Bumped whenever the tables change. Stores with an older schema are emptied, so the next fetch is a full fetch
+SCHEMA_VERSION = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    report_id TEXT PRIMARY KEY,
+    headers TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fetches (
+    report_id TEXT PRIMARY KEY,
+    fetched_at TEXT NOT NULL,
+    latest_period TEXT,
+    full_fetched_at TEXT
+);
+CREATE TABLE IF NOT EXISTS observations (
+    report_id TEXT NOT NULL,
+    REF_AREA TEXT NOT NULL,
+    SITREP_INDICATOR TEXT NOT NULL,
+    TIME_PERIOD TEXT NOT NULL,
+    attributes TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    PRIMARY KEY (report_id, REF_AREA, SITREP_INDICATOR, TIME_PERIOD, attributes)
+);
+CREATE INDEX IF NOT EXISTS observations_country ON observations (report_id, REF_AREA, position);
+CREATE INDEX IF NOT EXISTS observations_ref_area ON observations (REF_AREA);
+CREATE INDEX IF NOT EXISTS observations_indicator ON observations (SITREP_INDICATOR);
+CREATE INDEX IF NOT EXISTS observations_time_period ON observations (TIME_PERIOD);
+"""
+
+UPSERT = """
+INSERT INTO observations (report_id, REF_AREA, SITREP_INDICATOR, TIME_PERIOD, attributes, position, row)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (report_id, REF_AREA, SITREP_INDICATOR, TIME_PERIOD, attributes) DO UPDATE SET row = excluded.row
+"""
+
+
+class StoreRows(object):
+    """Re-iterable rows of one situation report for one country, queried from the store on demand."""
+
+    __slots__ = ("path", "report_id", "countryiso", "headers", "count")
+
+    def __init__(self, path, report_id, countryiso, headers, count):
+        self.path = path
+        self.report_id = report_id
+        self.countryiso = countryiso
+        self.headers = headers
+        self.count = count
+
+    def __iter__(self):
+        with closing(sqlite3.connect(self.path)) as connection:
+            cursor = connection.execute(
+                "SELECT row FROM observations WHERE report_id = ? AND REF_AREA = ? ORDER BY position",
+                (self.report_id, self.countryiso),
+            )
+            yield from compact_rows(self.headers, (json.loads(row) for row, in cursor))
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "StoreRows(%s, %s, %d rows)" % (self.report_id, self.countryiso, self.count)
+
+
+class ObservationStore(object):
+    """
+    Observations of each situation report keyed on report and KEY_FIELDS, in the order in which they were first
+    downloaded. Only one process should write to the store at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            tables = [name for name, in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            if tables:
+                logger.warning("Observation store %s has schema version %d, not %d. Emptying it" %
+                               (path, version, SCHEMA_VERSION))
+            for table in tables:
+                self.connection.execute("DROP TABLE %s" % table)
+            self.connection.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.connection.executescript(SCHEMA)
+
+    def update_report(self, report_id, headers, rows, complete=True, fetched_at=None):
+        """
+        Upsert rows of a report. If complete, the rows are the report's full history so stored observations that are
+        not in rows (withdrawn upstream) are deleted. fetched_at (the time the rows were requested, which is also the
+        time of the last full fetch if complete) and the latest TIME_PERIOD stored are recorded for incremental
+        fetches. Returns the number of rows written.
+        """
+        connection = self.connection
+        written = 0
+        with connection:
+            if complete:
+                connection.execute("DELETE FROM observations WHERE report_id = ?", (report_id,))
+                position = 0
+            else:
+                position = connection.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM observations WHERE report_id = ?", (report_id,)
+                ).fetchone()[0]
+            if headers or complete:
+                connection.execute(
+                    "INSERT OR REPLACE INTO reports (report_id, headers) VALUES (?, ?)",
+                    (report_id, json.dumps(headers)),
+                )
+            values = list()
+            for row in rows:
+                row = dict(row)
+                attributes = {field: value or "" for field, value in row.items()
+                              if field not in KEY_FIELDS and field not in MEASURE_FIELDS}
+                values.append(
+                    (report_id, *(row.get(field) or "" for field in KEY_FIELDS), json.dumps(attributes, sort_keys=True),
+                     position, json.dumps(row))
+                )
+                position += 1
+                if len(values) == 10000:
+                    connection.executemany(UPSERT, values)
+                    written += len(values)
+                    values = list()
+            connection.executemany(UPSERT, values)
+            written += len(values)
+            if fetched_at is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO fetches (report_id, fetched_at, latest_period, full_fetched_at) VALUES "
+                    "(?, ?, (SELECT MAX(TIME_PERIOD) FROM observations WHERE report_id = ? AND TIME_PERIOD != ''), "
+                    "COALESCE(?, (SELECT full_fetched_at FROM fetches WHERE report_id = ?)))",
+                    (report_id, fetched_at, report_id, fetched_at if complete else None, report_id),
+                )
+        return written
+
+    def last_fetch(self, report_id):
+        """
+        Time of the last recorded fetch of a report, the latest TIME_PERIOD stored and the time of the last full fetch,
+        or None if never fetched.
+        """
+        return self.connection.execute(
+            "SELECT fetched_at, latest_period, full_fetched_at FROM fetches WHERE report_id = ?", (report_id,)
+        ).fetchone()
+
+    def headers(self, report_id):
+        result = self.connection.execute("SELECT headers FROM reports WHERE report_id = ?", (report_id,)).fetchone()
+        return json.loads(result[0]) if result else None
+
+    def countriesdata(self, report_id, with_world=True):
+        """
+        Rows of a report split by country (in the order in which countries were first downloaded) as returned by
+        get_countriesdata, with each country's rows queried from the store when iterated.
+        """
+        headers = self.headers(report_id)
+        countriesdata = dict()
+        cursor = self.connection.execute(
+            "SELECT REF_AREA, COUNT(*) FROM observations WHERE report_id = ? GROUP BY REF_AREA ORDER BY MIN(position)",
+            (report_id,),
+        )
+        for countryiso, count in cursor:
+            countriesdata[countryiso] = StoreRows(self.path, report_id, countryiso, headers, count)
+        if with_world and countriesdata:
+            countriesdata[WORLD] = WorldView(countriesdata)
+        return countriesdata, headers
+
+    def query(self, report_id=None, countryiso=None, indicator=None, start_period=None):
+        """Yield the stored rows (as dictionaries) matching all the given criteria, eg. for analysis."""
+        conditions = list()
+        parameters = list()
+        for column, value in (("report_id", report_id), ("REF_AREA", countryiso), ("SITREP_INDICATOR", indicator)):
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                parameters.append(value)
+        if start_period is not None:
+            conditions.append("TIME_PERIOD >= ?")
+            parameters.append(start_period)
+        sql = "SELECT row FROM observations"
+        if conditions:
+            sql = "%s WHERE %s" % (sql, " AND ".join(conditions))
+        for row, in self.connection.execute("%s ORDER BY report_id, position" % sql, parameters):
+            yield json.loads(row)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,30 @@
+"""
+Shared test setup.
+
+"""
+from hdx.data.resource import Resource
+from hdx.data.vocabulary import Vocabulary
+from hdx.hdx_configuration import Configuration
+from hdx.hdx_locations import Locations
+from hdx.location.country import Country
+
+APPROVED_TAGS = ("hxl", "children", "covid-19", "malnutrition", "hygiene", "health", "healthcare")
+
+
+def stub_hdx(locations, **configuration):
+    """
+    Create the HDX configuration from the keyword arguments and hold locations (as given to
+    Locations.set_validlocations), countries, formats and tags locally so that datasets and showcases can be
+    generated without calling HDX.
+    """
+    Configuration._create(**configuration)
+    Locations.set_validlocations(locations)
+    Country.countriesdata(use_live=False)
+    Resource.set_formatsdict({"csv": "csv"})
+    Vocabulary._tags_dict = True
+    Vocabulary._approved_vocabulary = {
+        "tags": [{"name": tag} for tag in APPROVED_TAGS],
+        "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
+        "name": "approved",
+    }
+    return Configuration
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the download cache.
+
+"""
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import exists, join
+from threading import Thread
+
+import pytest
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+
+from httpcache import CachingDownloader, DownloadCache
+from unicef import get_countriesdata
+
+
+class StubServer:
+    """Local stand-in for the SDMX endpoint honouring If-None-Match and counting full body transfers."""
+
+    def __init__(self):
+        self.bodies = {
+            "/data/1?format=csv": b"REF_AREA,TIME_PERIOD,OBS_VALUE\nAFG,2020-04,1\nAGO,2020-04,2\n",
+            "/data/2?format=csv": b"REF_AREA,TIME_PERIOD,OBS_VALUE\nAFG,2020-05,3\n",
+            "/data/3?format=csv": b"REF_AREA,TIME_PERIOD,OBS_VALUE\nAGO,2020-06,4\n",
+        }
+        self.full_transfers = 0
+        self.not_modified = 0
+        self.send_etags = True
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.bodies[self.path]
+                etag = '"%s"' % hashlib.md5(body).hexdigest()
+                if server.send_etags and self.headers.get("If-None-Match") == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                server.full_transfers += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("Content-Length", str(len(body)))
+                if server.send_etags:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestDownloadCache:
+    @pytest.fixture(scope="function")
+    def server(self):
+        server = StubServer()
+        yield server
+        server.close()
+
+    @pytest.fixture(scope="function")
+    def folder(self):
+        with temp_dir("test_httpcache", delete_if_exists=True) as folder:
+            yield folder
+
+    def test_warm_run(self, server, folder):
+        urls = ["%s/data/%d?format=csv" % (server.url, i) for i in (1, 2)]
+        with Download(user_agent="test") as downloader:
+            cache = DownloadCache(folder, 10000)
+            cold = [get_countriesdata(url, CachingDownloader(downloader, cache)) for url in urls]
+            assert server.full_transfers == 2
+            cache = DownloadCache(folder, 10000)
+            warm = [get_countriesdata(url, CachingDownloader(downloader, cache)) for url in urls]
+        assert server.full_transfers == 2
+        assert server.not_modified == 2
+        assert cache.full_transfers == 0
+        assert cache.not_modified == 2
+        assert warm == cold
+        assert warm[0][0]["AGO"] == [{"REF_AREA": "AGO", "TIME_PERIOD": "2020-04", "OBS_VALUE": "2"}]
+
+    def test_changed_and_unchanged_bodies(self, server, folder):
+        server.send_etags = False
+        url = "%s/data/1?format=csv" % server.url
+        with Download(user_agent="test") as downloader:
+            cachingdownloader = CachingDownloader(downloader, DownloadCache(folder, 10000))
+            get_countriesdata(url, cachingdownloader)
+            get_countriesdata(url, cachingdownloader)
+            assert cachingdownloader.cache.unchanged == 1
+            server.bodies["/data/1?format=csv"] = b"REF_AREA,TIME_PERIOD,OBS_VALUE\nAFG,2020-04,5\n"
+            countriesdata, headers = get_countriesdata(url, cachingdownloader)
+        assert cachingdownloader.cache.unchanged == 1
+        assert cachingdownloader.cache.full_transfers == 3
+        assert countriesdata["AFG"][0]["OBS_VALUE"] == "5"
+
+    def test_lru_eviction(self, server, folder):
+        urls = ["%s/data/%d?format=csv" % (server.url, i) for i in (1, 2, 3)]
+        cache = DownloadCache(folder, 110)
+        with Download(user_agent="test") as downloader:
+            cachingdownloader = CachingDownloader(downloader, cache)
+            paths = [cachingdownloader.fetch(url) for url in urls[:2]]
+            cachingdownloader.fetch(urls[0])
+            cachingdownloader.fetch(urls[2])
+        assert set(cache.index.keys()) == {urls[0], urls[2]}
+        assert exists(paths[0])
+        assert not exists(paths[1])
+        assert cache.size() <= 110
+        assert DownloadCache(folder, 110).index == cache.index
+        assert exists(join(folder, DownloadCache.index_filename))
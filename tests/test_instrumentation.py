@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for instrumentation.
+
+"""
+import pstats
+from os.path import join
+
+import instrumentation
+from instrumentation import Metrics, TimedIterator, capture, count, current, timed, timer
+
+
+class TestInstrumentation:
+    def test_timers_and_counters(self):
+        metrics = Metrics()
+        with metrics.timer("download", "AFG"):
+            metrics.count("rows_downloaded", 10, "AFG")
+        with metrics.timer("download"):
+            metrics.count("rows_downloaded", 5)
+        report = metrics.report()
+        assert report["stages"]["download"]["calls"] == 2
+        assert report["counters"] == {"rows_downloaded": 15}
+        assert report["countries"]["AFG"]["counters"] == {"rows_downloaded": 10}
+        assert list(report["countries"]["AFG"]["seconds"]) == ["download"]
+        metrics.merge(report)
+        report = metrics.report()
+        assert report["stages"]["download"]["calls"] == 4
+        assert report["counters"] == {"rows_downloaded": 30}
+        assert report["countries"]["AFG"]["counters"] == {"rows_downloaded": 20}
+
+    def test_capture(self):
+        @timed("build")
+        def build():
+            count("files_written", 3, "AFG")
+            return "built"
+
+        run_metrics = current()
+        with capture() as captured:
+            assert current() is captured
+            assert build() == "built"
+        assert current() is run_metrics
+        assert captured.report()["stages"]["build"]["calls"] == 1
+        assert captured.report()["countries"] == {"AFG": {"seconds": {}, "counters": {"files_written": 3}}}
+
+    def test_timed_iterator(self):
+        iterator = TimedIterator(iter(range(3)))
+        assert list(iterator) == [0, 1, 2]
+        assert iterator.seconds > 0
+
+    def test_profile(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(instrumentation, "PROFILE_STAGES", {"write_csv"})
+        monkeypatch.setenv("TEMP_DIR", str(tmpdir))
+        with timer("write_csv", "AFG"):
+            sorted(range(1000), reverse=True)
+        with timer("download"):
+            pass
+        assert sorted(path.basename for path in tmpdir.listdir()) == ["UNICEFSAM_profile_write_csv_AFG.prof"]
+        pstats.Stats(join(str(tmpdir), "UNICEFSAM_profile_write_csv_AFG.prof"))
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the indicator registry.
+
+"""
+import pickle
+from glob import glob
+from os.path import join
+
+import pytest
+from hdx.utilities.loader import load_yaml
+
+import registry
+from registry import IndicatorRegistry, RegistryError, field_mappings, load_registry
+from unicef import hxltags_from_config
+
+PROJECT_CONFIG_YAML = join("config", "project_configuration.yml")
+
+
+class TestIndicatorRegistry:
+    def test_compile(self):
+        config = load_yaml(PROJECT_CONFIG_YAML)
+        compiled = IndicatorRegistry(config)
+        reports = {key: value for key, value in config.items() if key.startswith("CV")}
+        assert list(compiled) == list(reports)
+        assert compiled == reports
+        assert compiled.settings["fetch_workers"] == config["fetch_workers"]
+        assert "CV_01_01" not in compiled.settings
+        assert compiled.urls["CV_01_01"] == config["CV_01_01"]["url"]
+        assert compiled.hxltags == hxltags_from_config(reports)
+        assert hxltags_from_config(compiled) == compiled.hxltags
+        for report_id in reports:
+            assert list(field_mappings(compiled, report_id)) == field_mappings(reports, report_id)
+        assert field_mappings(compiled, "CV_99_99") == ()
+        with pytest.raises(AttributeError):
+            compiled.urls = dict()
+        for restored in (pickle.loads(pickle.dumps(compiled)), IndicatorRegistry.from_json(compiled.to_json())):
+            assert restored == compiled
+            assert restored.settings == compiled.settings
+            assert restored.field_mappings == compiled.field_mappings
+            assert restored.hxltags == compiled.hxltags
+
+    def test_validation(self):
+        config = {
+            "fetch_workers": 1,
+            "CV_01_01": {"url": "http://url1", "filename": "filename1", "observation_field": "observation_field1",
+                         "observation_field_hxl": "#observation_field1"},
+            "CV_01_02": {"url": "http://url2", "observation_field": "observation_field2"},
+            "CV_01_03": {"filename": "filename3", "target_field_hxl": "#target_field3"},
+        }
+        with pytest.raises(RegistryError) as error:
+            IndicatorRegistry(config)
+        assert str(error.value) == (
+            "Invalid project configuration: CV_01_02 has no filename; CV_01_02 has observation_field but no "
+            "observation_field_hxl; CV_01_03 has no url; CV_01_03 has target_field_hxl but no target_field"
+        )
+
+    def test_load_registry(self, tmpdir, monkeypatch):
+        folder = str(tmpdir)
+        path = join(folder, "project_configuration.yml")
+        with open(path, "w", encoding="utf-8") as output:
+            output.write("fetch_workers: 2\nCV_01_01:\n  url: http://url1\n  filename: filename1\n")
+        compiled = load_registry(path, folder)
+        assert compiled.urls == {"CV_01_01": "http://url1"}
+        assert compiled.settings == {"fetch_workers": 2}
+
+        def load_yaml(*args):
+            raise AssertionError("The configuration should not be parsed again")
+
+        monkeypatch.setattr("hdx.utilities.loader.load_yaml", load_yaml)
+        # Unchanged file: read from the cache
+        assert load_registry(path, folder).urls == compiled.urls
+        cache_paths = glob(join(folder, "UNICEFSAM_registry_*.json"))
+        assert len(cache_paths) == 1
+        # Unreadable cache: compiled again
+        with open(cache_paths[0], "w", encoding="utf-8") as output:
+            output.write("[]")
+        with pytest.raises(AssertionError):
+            load_registry(path, folder)
+        monkeypatch.undo()
+        load_registry(path, folder)
+        monkeypatch.setattr("hdx.utilities.loader.load_yaml", load_yaml)
+        # Registry compiled by other code: compiled again
+        monkeypatch.setattr(registry, "REGISTRY_VERSION", registry.REGISTRY_VERSION + 1)
+        with pytest.raises(AssertionError):
+            load_registry(path, folder)
+        monkeypatch.undo()
+        # Changed file: compiled again
+        with open(path, "a", encoding="utf-8") as output:
+            output.write("CV_01_02:\n  url: http://url2\n")
+        with pytest.raises(RegistryError):
+            load_registry(path, folder)
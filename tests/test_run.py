@@ -0,0 +1,244 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the run script.
+
+"""
+import csv
+import json
+import subprocess
+import sys
+import uuid
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from os.path import join
+from threading import Event, Lock, Thread
+from time import sleep
+
+import pytest
+from hdx.utilities.loader import load_yaml
+from hdx.utilities.path import temp_dir
+from hdx.utilities.saver import save_yaml
+
+from tests import stub_hdx, test_unicef
+
+HDX_CLIENT_MODULES = ("hdx.hdx_configuration", "hdx.data", "hdx.facades", "pandas")
+
+
+class CKANStub:
+    """
+    Local stand-in for the CKAN API actions called to create datasets and showcases. It responds after latency
+    seconds and records the requests for each action, the number of files uploaded with each request, the number of
+    connections opened and the most requests in flight at once.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.packages = dict()
+        self.showcases = dict()
+        self.requests = list()
+        self.connections = 0
+        self.in_flight = self.max_in_flight = 0
+        self.lock = Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def setup(self):
+                super().setup()
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_POST(self):
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    action = self.path.rsplit("/", 1)[-1]
+                    data, files = stub.read_data(self)
+                    sleep(stub.latency)
+                    with stub.lock:
+                        stub.requests.append((action, files))
+                        result = stub.respond(action, data)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+                if result is None:
+                    body = {"success": False, "error": {"__type": "Not Found Error", "message": "Not found"}}
+                else:
+                    body = {"success": True, "result": result}
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(200 if result is not None else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def read_data(handler):
+        body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        content_type = handler.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            return (json.loads(body) if body else dict()), 0
+        message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: %s\r\n\r\n%s" % (content_type.encode(), body))
+        data = dict()
+        files = 0
+        for part in message.iter_parts():
+            if part.get_filename():
+                files += 1
+            else:
+                data[part.get_param("name", header="content-disposition")] = part.get_content()
+        return data, files
+
+    def respond(self, action, data):
+        if action == "package_show":
+            return self.packages.get(data["id"])
+        if action == "package_create":
+            package = self.packages[data["name"]] = {**data, "id": str(uuid.uuid4())}
+            return package
+        if action == "package_revise":
+            package_id = json.loads(data["match"])["id"]
+            package = [package for package in self.packages.values() if package["id"] == package_id][0]
+            package.update(json.loads(data["update"]))
+            for resource in package.get("resources", []):
+                resource.setdefault("id", str(uuid.uuid4()))
+            return {"package": package}
+        if action == "ckanext_showcase_show":
+            return self.showcases.get(data["id"])
+        if action == "ckanext_showcase_create":
+            showcase = self.showcases[data["name"]] = {**data, "id": str(uuid.uuid4())}
+            return showcase
+        if action.endswith("_list"):
+            return []
+        return {**data, "id": str(uuid.uuid4())}
+
+    def count(self, action):
+        return sum(1 for requested, _ in self.requests if requested == action)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestRun:
+    def test_import_is_lazy(self):
+        code = "import sys, run; print([m for m in sys.modules if m.startswith(%s)])" % (HDX_CLIENT_MODULES,)
+        output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+        assert output.strip() == "[]"
+
+    def test_dry_run(self, tmpdir):
+        folder = str(tmpdir)
+        config = {"http_cache_size": 0}
+        reports = test_unicef.TestScraperName
+        for report_id, rows in (("CV_01_01", reports.countrydata1), ("CV_01_02", reports.countrydata2)):
+            path = join(folder, "%s.csv" % report_id)
+            with open(path, "w", newline="", encoding="utf-8") as output:
+                writer = csv.DictWriter(output, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+            config[report_id] = {
+                "url": path,
+                "filename": report_id.lower(),
+                "observation_field": "observation_field_%s" % report_id,
+                "observation_field_hxl": "#observation_field_%s" % report_id,
+            }
+        project_config_yaml = join(folder, "project_configuration.yml")
+        save_yaml(config, project_config_yaml)
+        code = "\n".join([
+            "import logging, sys, run",
+            "from hdx.location.country import Country",
+            "from hdx.utilities.useragent import UserAgent",
+            "logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')",
+            "Country.countriesdata(use_live=False)",
+            "UserAgent.set_global(user_agent='test')",
+            "run.dry_run(%r)" % project_config_yaml,
+            "print([m for m in sys.modules if m.startswith(%s)])" % (HDX_CLIENT_MODULES,),
+        ])
+        output = subprocess.run(
+            [sys.executable, "-c", code], check=True, capture_output=True, text=True, env={**environ, "TEMP_DIR": folder}
+        ).stdout.splitlines()
+        assert "Afghanistan: 2 rows in 2 reports, would upload" in output
+        assert "Dry run: 2 of 2 countries would be uploaded" in output
+        assert output[-1] == "[]"
+
+    def test_build_world_stopped(self):
+        import run
+
+        class Builders:
+            @staticmethod
+            def submit(*args, **kwargs):
+                raise AssertionError("The world should not be built after a failure")
+
+        build = Future()
+        build.cancel()
+        build.set_running_or_notify_cancel()
+        stop = Event()
+        stop.set()
+        with pytest.raises(CancelledError):
+            run.build_world(Builders(), {"AFG": build}, stop, "folder")
+
+    def test_upload(self):
+        import run
+        from instrumentation import metrics
+        from unicef import build_dataset_and_showcase, get_all_countriesdata
+
+        stub = CKANStub()
+        try:
+            stub_hdx(
+                [{"name": "afg", "title": "Afghanistan"}, {"name": "world", "title": "World"}],
+                hdx_url=stub.url, hdx_key="test", user_agent="test",
+                project_config_yaml=join("tests", "config", "project_configuration.yml"),
+            )
+            config = load_yaml(join("tests", "config", "project_configuration.yml"))
+            qc_indicators = load_yaml(join("config", "project_configuration.yml"))["qc_indicators"]
+            reports = test_unicef.TestScraperName
+
+            class Downloader:
+                @staticmethod
+                def get_tabular_rows(url, *args, **kwargs):
+                    rows = {"http://url1": reports.countrydata1, "http://url2": reports.countrydata2}[url]
+                    return list(rows[0].keys()), rows
+
+            countries, countriesdata, headers = get_all_countriesdata(config, Downloader())
+            batch = str(uuid.uuid4())
+            api_calls = metrics.report()["counters"].get("api_calls", 0)
+            with temp_dir("test_run_upload", delete_if_exists=True) as folder, \
+                    ThreadPoolExecutor(max_workers=1) as showcasers, ThreadPoolExecutor(max_workers=1) as uploaders:
+                futures = list()
+                for country in countries:
+                    build = Future()
+                    build.set_result(build_dataset_and_showcase(
+                        folder, country, countriesdata[country["iso3"]], headers, config, qc_indicators
+                    ))
+                    futures.append(uploaders.submit(
+                        run.upload, build, country["iso3"], batch, qc_indicators, run.RateLimiter(None), showcasers
+                    ))
+                for future in futures:
+                    uploaded, _, _, showcase_upload = future.result()
+                    assert uploaded
+                    assert showcase_upload.result() > 0
+        finally:
+            stub.close()
+        assert len(countries) == 2
+        # All of a dataset's resource files (concatenated, QuickCharts, joined and 2 reports) go in one request, tagged
+        # with the batch
+        assert stub.count("package_create") == 2
+        assert [files for action, files in stub.requests if action == "package_revise"] == [5, 5]
+        assert all(package["batch"] == batch for package in stub.packages.values())
+        assert stub.count("ckanext_showcase_package_association_create") == 2
+        # The session's connections are kept alive and reused across countries
+        assert stub.connections <= 2 < len(stub.requests)
+        # A showcase is uploaded while the next country's dataset is
+        assert stub.max_in_flight == 2
+        assert metrics.report()["counters"]["api_calls"] - api_calls == 6
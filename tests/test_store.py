@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Unit tests for the observation store.
+
+"""
+import csv
+import io
+import pickle
+import sqlite3
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import join
+from threading import Thread
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from hdx.location.country import Country
+from hdx.utilities.downloader import Download
+
+from instrumentation import capture
+from store import ObservationStore
+from unicef import delta_parameters, delta_url, get_all_countriesdata
+
+HEADERS = ["REF_AREA", "SITREP_INDICATOR", "TIME_PERIOD", "DATA_SOURCE", "OBS_VALUE"]
+
+
+def row(countryiso, timeperiod, value, indicator="CV-01-01"):
+    return dict(zip(HEADERS, [countryiso, indicator, timeperiod, "Source1", value]))
+
+
+class Downloader:
+    def __init__(self, reports):
+        self.reports = reports
+
+    def get_tabular_rows(self, url, *args, **kwargs):
+        return HEADERS, self.reports[url]
+
+
+class SDMXStub:
+    """Local stand-in for the SDMX endpoint honouring the startPeriod and updatedAfter query parameters."""
+
+    def __init__(self, rows):
+        self.rows = rows  # list of (updated timestamp, row)
+        self.requests = list()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlsplit(self.path).query)
+                start_period = query.get("startPeriod", [""])[0]
+                updated_after = query.get("updatedAfter", [""])[0]
+                rows = [row for updated, row in stub.rows
+                        if row["TIME_PERIOD"] >= start_period and updated > updated_after]
+                stub.requests.append((query, len(rows)))
+                output = io.StringIO()
+                writer = csv.DictWriter(output, fieldnames=HEADERS)
+                writer.writeheader()
+                writer.writerows(rows)
+                body = output.getvalue().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.CV-01-01?format=csv" % \
+            self.httpd.server_address[1]
+        Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestObservationStore:
+    def test_update_and_query(self, tmpdir):
+        store = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        rows = [row("AGO", "2020-04-30", "1"), row("AFG", "2020-04-30", "2"), row("AGO", "2020-05-31", "3")]
+        assert store.update_report("CV_01_01", HEADERS, rows) == 3
+        countriesdata, headers = store.countriesdata("CV_01_01")
+        assert headers == HEADERS
+        assert list(countriesdata.keys()) == ["AGO", "AFG", "world"]
+        assert len(countriesdata["AGO"]) == 2
+        assert countriesdata["AGO"] == [rows[0], rows[2]]
+        assert countriesdata["world"] == [rows[0], rows[2], rows[1]]
+        assert pickle.loads(pickle.dumps(countriesdata["AFG"])) == [rows[1]]
+        # Partial update: upserts the changed observation and appends the new one
+        store.update_report("CV_01_01", HEADERS, [row("AFG", "2020-04-30", "5"), row("AFG", "2020-05-31", "6")],
+                            complete=False)
+        assert [r["OBS_VALUE"] for r in store.query(countryiso="AFG")] == ["5", "6"]
+        assert [r["OBS_VALUE"] for r in store.query(start_period="2020-05")] == ["3", "6"]
+        # Observations differing only in DATA_SOURCE are kept apart, as in the downloaded data
+        store.update_report("CV_01_01", HEADERS, [dict(row("AFG", "2020-05-31", "7"), DATA_SOURCE="Source2")],
+                            complete=False)
+        assert [(r["DATA_SOURCE"], r["OBS_VALUE"]) for r in store.query(countryiso="AFG")] == [
+            ("Source1", "5"), ("Source1", "6"), ("Source2", "7")
+        ]
+        # Complete update: replaces the report's observations
+        store.update_report("CV_01_01", HEADERS, [row("AFG", "2020-04-30", "7")])
+        assert list(store.query()) == [row("AFG", "2020-04-30", "7")]
+        store.close()
+
+    def test_schema_version(self, tmpdir):
+        path = join(str(tmpdir), "observations.sqlite")
+        with closing(sqlite3.connect(path)) as connection:
+            connection.execute("CREATE TABLE fetches (report_id TEXT PRIMARY KEY, fetched_at TEXT NOT NULL)")
+            connection.execute("INSERT INTO fetches VALUES ('CV_01_01', '2020-05-01T00:00:00Z')")
+            connection.commit()
+        # A store written by older code is emptied so that the report is fetched in full again
+        store = ObservationStore(path)
+        assert store.last_fetch("CV_01_01") is None
+        store.update_report("CV_01_01", HEADERS, [row("AFG", "2020-04-30", "1")], fetched_at="2020-06-01T00:00:00Z")
+        store.close()
+        store = ObservationStore(path)
+        assert store.last_fetch("CV_01_01") == ("2020-06-01T00:00:00Z", "2020-04-30", "2020-06-01T00:00:00Z")
+        store.close()
+
+    def test_get_all_countriesdata(self, tmpdir):
+        Country.countriesdata(use_live=False)
+        config = {"CV_01_01": {"url": "url1"}, "CV_01_02": {"url": "url2"}}
+        downloader = Downloader({
+            "url1": [row("AFG", "2020-04-30", "1"), row("AGO", "2020-04-30", "2"), row("AFG", "2020-05-31", "3"),
+                     dict(row("AFG", "2020-05-31", "8"), DATA_SOURCE="Source2")],
+            "url2": [row("AGO", "2020-04-30", "4", "CV-01-02")],
+        })
+        expected = get_all_countriesdata(config, downloader)
+        store = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        # The same rows as without the store, including those differing only in DATA_SOURCE
+        assert get_all_countriesdata(config, downloader, store=store) == expected
+        assert len(expected[1]["AFG"]["CV_01_01"]) == 3
+        store.close()
+        # A later run can read the stored observations without downloading them
+        store = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        assert [r["OBS_VALUE"] for r in store.query(indicator="CV-01-02")] == ["4"]
+        store.close()
+
+    def test_delta_url(self):
+        url = "https://sdmx.data.unicef.org/ws/public/sdmxapi/rest/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.CV-01-01"
+        assert delta_url("%s?format=csv" % url, startPeriod="2020-05") == "%s?format=csv&startPeriod=2020-05" % url
+        assert delta_url("%s?format=csv&startPeriod=2020-01" % url, updatedAfter="2020-06-01T00:00:00Z") == \
+            "%s?format=csv&startPeriod=2020-01&updatedAfter=2020-06-01T00:00:00Z" % url
+
+    def test_delta_parameters(self, tmpdir):
+        store = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        assert delta_parameters(store, "CV_01_01", "startPeriod") is None
+        store.update_report("CV_01_01", HEADERS, [row("AFG", "2020-04", "1")], fetched_at="2020-05-01T00:00:00Z")
+        store.update_report("CV_01_01", HEADERS, [row("AFG", "2020-05", "2")], complete=False,
+                            fetched_at="2020-06-01T00:00:00Z")
+        assert store.last_fetch("CV_01_01") == ("2020-06-01T00:00:00Z", "2020-05", "2020-05-01T00:00:00Z")
+        assert delta_parameters(store, "CV_01_01", "startPeriod", "2020-06-05T00:00:00Z") == {"startPeriod": "2020-05"}
+        assert delta_parameters(store, "CV_01_01", "updatedAfter", "2020-06-05T00:00:00Z", 60) == {
+            "updatedAfter": "2020-06-01T00:00:00Z"
+        }
+        # The last full fetch is over full_fetch_days old: fetch the full history again
+        assert delta_parameters(store, "CV_01_01", "startPeriod", "2020-06-05T00:00:00Z", 40) is not None
+        assert delta_parameters(store, "CV_01_01", "startPeriod", "2020-06-05T00:00:00Z", 30) is None
+        store.close()
+
+    @pytest.mark.parametrize("incremental", ["startPeriod", "updatedAfter"])
+    def test_incremental_fetch(self, tmpdir, incremental):
+        Country.countriesdata(use_live=False)
+        stub = SDMXStub([
+            ("2020-05-01T00:00:00Z", row(countryiso, "2020-%02d" % month, str(month)))
+            for countryiso in ("AFG", "AGO") for month in range(1, 5)
+        ])
+        config = {"CV_01_01": {"url": stub.url}}
+        store = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        try:
+            with Download(user_agent="test") as downloader:
+                get_all_countriesdata(config, downloader, store=store, incremental=incremental)
+                assert {rows for _, rows in stub.requests} == {8}
+                # Next month: the latest period is revised and a new period is published
+                stub.rows[7] = ("2099-01-01T00:00:00Z", row("AGO", "2020-04", "40"))
+                stub.rows.append(("2099-01-01T00:00:00Z", row("AFG", "2020-05", "5")))
+                del stub.requests[:]
+                with capture() as metrics:
+                    countries, countriesdata, headers = get_all_countriesdata(
+                        config, downloader, store=store, incremental=incremental
+                    )
+                delta_query, delta_rows = stub.requests[-1]
+                full = get_all_countriesdata(config, downloader)
+        finally:
+            store.close()
+            stub.close()
+        if incremental == "startPeriod":
+            assert delta_query["startPeriod"] == ["2020-04"]
+            assert delta_rows == 3
+        else:
+            assert "updatedAfter" in delta_query
+            assert delta_rows == 2
+        # Only the delta is downloaded but the whole history is stored
+        counters = metrics.report()["counters"]
+        assert counters["rows_downloaded"] == delta_rows
+        assert counters["rows_stored"] == 9
+        assert (countries, countriesdata, headers) == full
+        assert [r["OBS_VALUE"] for r in countriesdata["AGO"]["CV_01_01"]] == ["1", "2", "3", "40"]
+        assert [r["OBS_VALUE"] for r in countriesdata["AFG"]["CV_01_01"]] == ["1", "2", "3", "4", "5"]
@@ -4,21 +4,38 @@
 Unit tests for UNICEF SAM.
 
 """
-from os.path import join
+import csv
+import gzip
+import pickle
+from os.path import basename, join
+from sys import intern
 
 import pytest
-from hdx.hdx_configuration import Configuration
 from hdx.hdx_locations import Locations
-from hdx.location.country import Country
+from hdx.data.resource import Resource
 from hdx.utilities.loader import load_yaml
 from hdx.utilities.path import temp_dir
-from hdx.data.vocabulary import Vocabulary
+from instrumentation import capture
+from tests import stub_hdx
+from store import ObservationStore
 from unicef import (
+    batch_id,
+    build_dataset_and_showcase,
+    restore_dataset_and_showcase,
     generate_dataset_and_showcase,
     get_countriesdata,
     get_all_countriesdata,
     join_reports,
+    compact_rows,
     concat_reports,
+    country_fingerprint,
+    demultiplex,
+    fetch_report,
+    group_requests,
+    PartitionRows,
+    QuickChartsIndex,
+    ReportJoiner,
+    RunMetadata,
     hxltags_from_config
 )
 
@@ -49,22 +66,12 @@ class TestScraperName:
 
     @pytest.fixture(scope="function")
     def configuration(self):
-        Configuration._create(
+        return stub_hdx(
+            [{"name": "afg", "title": "Afghanistan"}],  # add locations used in tests
             hdx_read_only=True,
             user_agent="test",
             project_config_yaml=join("tests", "config", "project_configuration.yml"),
         )
-        Locations.set_validlocations(
-            [{"name": "afg", "title": "Afghanistan"}]
-        )  # add locations used in tests
-        Country.countriesdata(False)
-        Vocabulary._tags_dict = True
-        Vocabulary._approved_vocabulary = {
-            "tags": [{"name": "hxl"}, {"name": "xxx"}, {"name": "yyy"}],
-            "id": "4e61d464-4943-4e97-973a-84673c1aaa87",
-            "name": "approved",
-        }
-        return Configuration
 
     @pytest.fixture(scope="function")
     def config(self):
@@ -94,6 +101,45 @@ class TestScraperName:
         assert countriesdata["AFG"] == TestScraperName.countrydata1
         assert countriesdata["world"] == TestScraperName.countrydata1
 
+    def test_world_view(self):
+        rows = TestScraperName.countrydata1 + TestScraperName.countrydata2 + [
+            {**TestScraperName.countrydata1[0], "REF_AREA": "AGO"}
+        ]
+
+        class Downloader:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                return list(rows[0].keys()), rows
+
+        countriesdata, headers = get_countriesdata("http://url", Downloader())
+        assert len(countriesdata["AFG"]) == 2
+        world = countriesdata["world"]
+        assert len(world) == 3
+        assert world == rows
+        assert all(a is b for a, b in zip(world, countriesdata["AFG"] + countriesdata["AGO"]))
+        countriesdata, headers = get_countriesdata("http://url", Downloader(), with_world=False)
+        assert "world" not in countriesdata
+
+    def test_compact_rows(self):
+        headers = ["REF_AREA", "Geographic area", "OBS_VALUE"]
+        rows = list(compact_rows(headers, [["AFG", "Afghan" + "istan", "1"], {"REF_AREA": "AFG", "OBS_VALUE": "2"}]))
+        assert rows == [
+            {"REF_AREA": "AFG", "Geographic area": "Afghanistan", "OBS_VALUE": "1"},
+            {"REF_AREA": "AFG", "Geographic area": None, "OBS_VALUE": "2"},
+        ]
+        assert rows[0].columns is rows[1].columns
+        assert rows[0]["Geographic area"] is intern("Afghanistan")
+        assert list(rows[0].keys()) == headers
+        assert rows[1].get("TARGET", "") == ""
+        with pytest.raises(KeyError):
+            rows[0]["TARGET"]
+        assert pickle.loads(pickle.dumps(rows)) == rows
+        # Measures between interned columns and short rows
+        headers = ["REF_AREA", "OBS_VALUE", "Geographic area", "TARGET"]
+        rows = list(compact_rows(headers, [["AFG", "1", "Afghanistan", "5"], ["AGO", "2"]]))
+        assert [row.values for row in rows] == [("AFG", "1", "Afghanistan", "5"), ("AGO", "2", None, None)]
+        assert rows[1]["REF_AREA"] is intern("AGO")
+
     def test_get_all_countriesdata(self, downloader, config):
         countries, countriesdata, headers = get_all_countriesdata(config, downloader)
         assert set(c["iso3"] for c in countries) == set(["AFG", "world"])
@@ -103,24 +149,260 @@ class TestScraperName:
         assert countriesdata["AFG"]["CV_01_02"] == TestScraperName.countrydata2
         assert countriesdata["world"]["CV_01_02"] == TestScraperName.countrydata2
 
+    def test_get_all_countriesdata_concurrent(self, downloader, config):
+        expected = get_all_countriesdata(config, downloader)
+        downloaders = []
+
+        def downloader_factory():
+            downloaders.append(downloader)
+            return downloader
+
+        downloader.close = lambda: None
+        result = get_all_countriesdata(config, downloader, fetch_workers=4, downloader_factory=downloader_factory)
+        assert result == expected
+        assert list(result[1]["AFG"].keys()) == ["CV_01_01", "CV_01_02"]
+        assert 1 <= len(downloaders) <= 2
+        # Without a factory the downloader is not shared between threads
+        assert get_all_countriesdata(config, downloader, fetch_workers=4) == expected
+
+    def test_get_all_countriesdata_spooled(self, downloader, config):
+        expected = get_all_countriesdata(config, downloader)
+        with temp_dir("test_unicef_partitions", delete_if_exists=True) as folder:
+            countries, countriesdata, headers = get_all_countriesdata(config, downloader, spool_folder=folder)
+            assert countries == expected[0]
+            assert headers == expected[2]
+            assert countriesdata == expected[1]
+            assert isinstance(countriesdata["AFG"]["CV_01_01"], PartitionRows)
+            assert countriesdata["AFG"]["CV_01_01"].path == join(folder, "CV_01_01", "AFG.csv")
+            assert len(countriesdata["world"]["CV_01_02"]) == 1
+            rows, _ = concat_reports(countriesdata["world"])
+            assert [row["OBS_VALUE"] for row in rows] == ["1", "3"]
+
+    def test_group_requests(self):
+        url = "https://sdmx/data/UNICEF.EMOPS,DF_SITREP_COVID19,1.0/.%s?format=csv"
+        config = {"CV_%02d" % i: {"identifier": "CV-%02d" % i} for i in range(1, 5)}
+        config["OTHER"] = {"identifier": "OTHER-1"}
+        urls = {report_id: url % report_config["identifier"] for report_id, report_config in config.items()}
+        urls["OTHER"] = "https://other/data.csv"
+        assert group_requests(urls, config) == [([report_id], url, None) for report_id, url in urls.items()]
+        max_length = len(url % "CV-01+CV-02+CV-03")
+        assert group_requests(urls, config, max_length) == [
+            (["CV_01", "CV_02", "CV_03"], url % "CV-01+CV-02+CV-03",
+             {"CV-01": "CV_01", "CV-02": "CV_02", "CV-03": "CV_03"}),
+            (["CV_04"], url % "CV-04", None),
+            (["OTHER"], "https://other/data.csv", None),
+        ]
+
+    def test_get_all_countriesdata_batched(self, config):
+        rows = {"CV-01-01": TestScraperName.countrydata1, "CV-01-02": TestScraperName.countrydata2}
+        requested = []
+
+        class SDMXDownloader:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                requested.append(url)
+                indicators = url.split("/.")[-1].split("?")[0].split("+")
+                return sorted(TestScraperName.countrydata1[0].keys()), [
+                    row for indicator in indicators for row in rows[indicator]
+                ]
+
+        for report_config in config.values():
+            report_config["url"] = "http://sdmx/data/DF_SITREP_COVID19/.%s?format=csv" % report_config["identifier"]
+        expected = get_all_countriesdata(config, SDMXDownloader())
+        assert len(requested) == 2
+        requested.clear()
+        assert get_all_countriesdata(config, SDMXDownloader(), batch_url_length=100) == expected
+        assert requested == ["http://sdmx/data/DF_SITREP_COVID19/.CV-01-01+CV-01-02?format=csv"]
+        with temp_dir("test_unicef_partitions", delete_if_exists=True) as folder:
+            countries, countriesdata, headers = get_all_countriesdata(
+                config, SDMXDownloader(), batch_url_length=100, spool_folder=folder
+            )
+            assert (countries, countriesdata, headers) == expected
+            assert countriesdata["AFG"]["CV_01_02"].path == join(
+                folder, batch_id(["CV_01_01", "CV_01_02"]), "CV_01_02", "AFG.csv"
+            )
+
+    def test_get_all_countriesdata_batched_many(self):
+        # Enough reports that their ids joined together would be too long for a folder name
+        config = {
+            "CV_%02d_01" % i: {"identifier": "CV-%02d-01" % i,
+                               "url": "http://sdmx/data/DF_SITREP_COVID19/.CV-%02d-01?format=csv" % i}
+            for i in range(1, 61)
+        }
+        headers = sorted(TestScraperName.countrydata1[0].keys())
+
+        class SDMXDownloader:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                indicators = url.split("/.")[-1].split("?")[0].split("+")
+                return headers, [[{**TestScraperName.countrydata1[0], "SITREP_INDICATOR": indicator}[header]
+                                  for header in headers] for indicator in indicators]
+
+        assert len(group_requests({report_id: c["url"] for report_id, c in config.items()}, config, 10000)) == 1
+        assert len("+".join(config)) > 255
+        with temp_dir("test_unicef_partitions", delete_if_exists=True) as folder:
+            countries, countriesdata, _ = get_all_countriesdata(
+                config, SDMXDownloader(), batch_url_length=10000, spool_folder=folder
+            )
+            assert list(countriesdata["AFG"]) == list(config)
+            assert [row["SITREP_INDICATOR"] for row in countriesdata["AFG"]["CV_60_01"]] == ["CV-60-01"]
+
+    def test_demultiplex_spooled(self, monkeypatch):
+        import unicef
+
+        headers = sorted(TestScraperName.countrydata1[0].keys())
+        rows = [dict(row, SITREP_INDICATOR=indicator, REF_AREA=countryiso)
+                for countryiso in ("AFG", "AGO", "ALB") for indicator in ("CV-01-01", "CV-01-02")
+                for row in TestScraperName.countrydata1]
+
+        class Download:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                return headers, [[row[header] for header in headers] for row in rows]
+
+        countriesdata, _ = get_countriesdata("url", Download(), with_world=False)
+        partitions = []
+        most_open = 0
+
+        def open_partition(*args):
+            nonlocal most_open
+            partitions.append(original(*args))
+            most_open = max(most_open, sum(not output.closed for output, _, _ in partitions))
+            return partitions[-1]
+
+        original = unicef.open_partition
+        monkeypatch.setattr(unicef, "open_partition", open_partition)
+        with temp_dir("test_unicef_demultiplex", delete_if_exists=True) as folder:
+            reports = demultiplex(countriesdata, headers, {"CV-01-01": "CV_01_01", "CV-01-02": "CV_01_02"},
+                                  spool_folder=folder)
+            # One file per report for the current country, not one per report and country
+            assert len(partitions) == 6
+            assert most_open == 2
+            assert all(output.closed for output, _, _ in partitions)
+            assert reports["CV_01_02"][0]["AGO"] == [
+                row for row in rows if row["REF_AREA"] == "AGO" and row["SITREP_INDICATOR"] == "CV-01-02"
+            ]
+
+    def test_fetch_report_retries(self, downloader):
+        calls = []
+
+        class FlakyDownloader:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                calls.append(kwargs)
+                if len(calls) < 3:
+                    raise Exception("Temporary failure")
+                return downloader.get_tabular_rows(url, *args, **kwargs)
+
+        countriesdata, headers = fetch_report("CV_01_01", "http://url1", FlakyDownloader(), timeout=5, retries=2, backoff=0)
+        assert countriesdata["AFG"] == TestScraperName.countrydata1
+        assert len(calls) == 3
+        assert calls[0]["http_timeout"] == 5
+        with pytest.raises(Exception):
+            calls.clear()
+            fetch_report("CV_01_01", "http://url1", FlakyDownloader(), retries=1, backoff=0)
+
     def test_join_reports(self, downloader, config):
         countries, countriesdata, headers = get_all_countriesdata(config, downloader)
         rows, headers = join_reports(countriesdata["AFG"], config)
+        assert iter(rows) is rows  # yielded lazily
+        rows = list(rows)
         assert len(rows) == 1
         assert rows[0]["observation_field1"]=='1'
         assert rows[0]["target_field1"]=='2'
         assert rows[0]["observation_field2"]=='3'
         assert "target_field2" not in rows[0]
 
+    def test_report_joiner_order(self, downloader, config):
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        # Both reports map to observation_field1: the value of the later report in config order wins
+        config["CV_01_02"]["observation_field"] = "observation_field1"
+        countrydata = countriesdata["world"]
+        joiner = ReportJoiner(config, countrydata.keys())
+        for report_id in sorted(countrydata.keys(), reverse=True):
+            for row in countrydata[report_id]:
+                joiner.add(report_id, row)
+        expected_rows, expected_headers = join_reports(countrydata, config)
+        rows = list(joiner.rows())
+        assert (rows, joiner.headers) == (list(expected_rows), expected_headers)
+        assert rows[0]["observation_field1"] == "3"
+
+    def test_join_reports_pandas(self, downloader, config):
+        pytest.importorskip("pandas")
+        for report_config in (config, dict(reversed(list(config.items())))):
+            countries, countriesdata, headers = get_all_countriesdata(report_config, self.world_downloader())
+            for countryiso in ("AFG", "AGO", "world"):
+                rows, headers = join_reports(countriesdata[countryiso], report_config, engine="pandas")
+                expected_rows, expected_headers = join_reports(countriesdata[countryiso], report_config)
+                assert (list(rows), headers) == (list(expected_rows), expected_headers)
+        countrydata = {
+            "CV_01_02": TestScraperName.countrydata2,
+            "CV_01_01": TestScraperName.countrydata1 + [
+                {**TestScraperName.countrydata1[0], "TIME_PERIOD": "2020-5-9", "TARGET": None},
+                {**TestScraperName.countrydata1[0], "OBS_VALUE": "5"},
+            ],
+        }
+        rows, headers = join_reports(countrydata, config, engine="pandas")
+        rows = list(rows)
+        expected_rows, expected_headers = join_reports(countrydata, config)
+        assert (rows, headers) == (list(expected_rows), expected_headers)
+        assert headers == [
+            "REF_AREA", "Geographic area", "TIME_PERIOD", "DATA_SOURCE",
+            "observation_field2", "observation_field1", "target_field1",
+        ]
+        assert [row["observation_field1"] for row in rows] == ["5", "1"]
+        assert rows[1]["target_field1"] is None
+        assert "observation_field2" not in rows[1]
+
     def test_concat_reports(self, downloader, config):
         countries, countriesdata, headers = get_all_countriesdata(config, downloader)
         rows, headers = concat_reports(countriesdata["AFG"])
+        assert iter(rows) is rows  # yielded lazily
+        rows = list(rows)
         assert len(rows) == 2
         assert rows[0]["OBS_VALUE"]=='1'
         assert rows[0]["TARGET"]=='2'
         assert rows[1]["OBS_VALUE"]=='3'
         assert rows[1]["TARGET"]=='4'
 
+    def test_country_fingerprint(self, downloader, config):
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        qc_indicators = [{"code": "CV-01-01"}]
+        fingerprint = country_fingerprint(countriesdata["AFG"], headers, config, qc_indicators)
+        assert fingerprint == country_fingerprint(countriesdata["AFG"], headers, config, qc_indicators)
+        with temp_dir("test_unicef_partitions", delete_if_exists=True) as folder:
+            countries, spooled, headers = get_all_countriesdata(config, downloader, spool_folder=folder)
+            assert country_fingerprint(spooled["AFG"], headers, config, qc_indicators) == fingerprint
+        assert country_fingerprint(countriesdata["AFG"], headers, config, [{"code": "CV-01-02"}]) != fingerprint
+        changed_config = {**config, "CV_01_02": {**config["CV_01_02"], "observation_field": "changed"}}
+        assert country_fingerprint(countriesdata["AFG"], headers, changed_config, qc_indicators) != fingerprint
+        changed_data = {**countriesdata["AFG"], "CV_01_01": [{**TestScraperName.countrydata1[0], "OBS_VALUE": "5"}]}
+        assert country_fingerprint(changed_data, headers, config, qc_indicators) != fingerprint
+
+    def test_concat_reports_headers(self, downloader, config):
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        rows, concatheaders = concat_reports(countriesdata["world"], headers)
+        assert len(list(rows)) == 2
+        assert concatheaders[:14] == [
+            "REF_AREA",
+            "Geographic area",
+            "SITREP_INDICATOR",
+            "Situation Report Indicator",
+            "HAC_PILLAR",
+            "Humanitarian Action for Children Pillar",
+            "UNIT_MEASURE",
+            "Unit of measure",
+            "TIME_PERIOD",
+            "OBS_VALUE",
+            "DATA_SOURCE",
+            "TARGET",
+            "OBS_STATUS",
+            "Observation status",
+        ]
+        assert concatheaders[14:] == []
+        headers["CV_01_02"] = headers["CV_01_02"] + ["EXTRA_2", "EXTRA_1"]
+        assert concat_reports(countriesdata["world"], headers)[1][14:] == ["EXTRA_1", "EXTRA_2"]
+
     def test_hxltags_from_config(self, config):
         tags = hxltags_from_config(config)
         assert tags == dict(
@@ -129,15 +411,232 @@ class TestScraperName:
             observation_field2="#observation_field2",
         )
 
-#    def test_generate_dataset_and_showcase(self, configuration, downloader, config):
-#        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
-#        country = [c for c in countries if c["iso3"]=="AFG"][0]
-#        countrydata = countriesdata[country["iso3"]]
-#        with temp_dir('scrapername') as folder:  # if you need a temporary folder that will be deleted
-#            dataset, showcase = generate_dataset_and_showcase(folder, country, countrydata, headers, config)
-#            assert dataset == {...}
-#
-#            resources = dataset.get_resources()
-#            assert resources == [...]
-#
-#            assert showcase == {...}
+    def test_run_metadata(self, configuration, config):
+        metadata = RunMetadata(config, [{"code": "CV-01-01"}], [{"iso3": "AFG", "name": "Afghanistan"}])
+        afg = metadata.countries["AFG"]
+        assert afg["slugified_name"] == "unicef-covid-19-situation-report-for-afghanistan"
+        assert afg["groups"] == [{"name": "afg"}]
+        assert metadata.country({"iso3": "AFG", "name": "Afghanistan"}) is afg
+        assert metadata.country({"iso3": "AGO", "name": "Angola"})["groups"] is None
+        assert metadata.hxltags["observation_field2"] == "#observation_field2"
+        assert metadata.qc_codes == ["CV-01-01"]
+        assert [tag["name"] for tag in metadata.dataset_template["tags"]][:2] == ["hxl", "children"]
+
+    def test_generate_dataset_and_showcase(self, configuration, downloader, config):
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        country = [c for c in countries if c["iso3"] == "AFG"][0]
+        countrydata = countriesdata[country["iso3"]]
+        qc_indicators = [{"code": "CV-01-01"}, {"code": "CV-01-02"}, {"code": "CV-03-04"}]
+        with temp_dir("test_unicef", delete_if_exists=True) as folder:
+            dataset, showcase, bites_disabled = generate_dataset_and_showcase(
+                folder, country, countrydata, headers, config, qc_indicators
+            )
+            assert dataset["name"] == "unicef-covid-19-situation-report-for-afghanistan"
+            assert dataset["title"] == "Afghanistan - COVID-19 Situation Report"
+            assert dataset["groups"] == [{"name": "afg"}]
+            resources = dataset.get_resources()
+            assert [resource["name"] for resource in resources] == [
+                "Concatenated COVID-19 Situation Report Data - Afghanistan",
+                "QuickCharts-Concatenated COVID-19 Situation Report Data - Afghanistan",
+                "Joined COVID-19 Situation Report Data - Afghanistan",
+                "name1 - Afghanistan",
+                "name2 - Afghanistan",
+            ]
+            assert bites_disabled == [False, False, True]
+            assert showcase["name"] == "unicef-covid-19-situation-report-for-afghanistan-showcase"
+            with open(join(folder, "covid19sitrep_joined_afg.csv")) as input:
+                assert input.read().splitlines() == [
+                    "REF_AREA,Geographic area,TIME_PERIOD,DATA_SOURCE,observation_field1,target_field1,observation_field2",
+                    "#country+code,#country+name,#date,#meta+source,#observation_field1,#target_field1,#observation_field2",
+                    "AFG,Afghanistan,2020-4-9,Source1,1,2,3",
+                ]
+            with open(join(folder, "qc_covid19sitrep_concat_afg.csv")) as input:
+                assert input.read().splitlines() == [
+                    "REF_AREA,SITREP_INDICATOR,TIME_PERIOD,OBS_VALUE",
+                    "#country+code,#indicator+code,#date,#indicator+value+num",
+                    "AFG,CV-01-01,2020-4-9,1",
+                    "AFG,CV-01-02,2020-4-9,3",
+                ]
+            assert dataset["dataset_date"] == "[2020-04-09T00:00:00 TO 2020-04-09T00:00:00]"
+            # A country without QuickCharts rows still has the (empty) QuickCharts resource
+            dataset, _, bites_disabled = generate_dataset_and_showcase(
+                folder, country, countrydata, headers, config, [{"code": "CV-03-04"}]
+            )
+            assert [resource["name"] for resource in dataset.get_resources()] == [
+                resource["name"] for resource in resources
+            ]
+            assert bites_disabled == [True, True, True]
+            with open(join(folder, "qc_covid19sitrep_concat_afg.csv")) as input:
+                assert len(input.read().splitlines()) == 2
+
+    def test_output_formats(self, configuration, downloader, config):
+        pyarrow = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        country = [c for c in countries if c["iso3"] == "AFG"][0]
+        Resource.set_formatsdict({"csv": "csv", "gzip": "gzip", "parquet": "parquet"})
+        with temp_dir("test_unicef", delete_if_exists=True) as folder:
+            with capture() as metrics:
+                dataset, _, _ = generate_dataset_and_showcase(
+                    folder, country, countriesdata["AFG"], headers, config, [], output_formats=["csv.gz", "parquet"]
+                )
+            assert [resource["name"] for resource in dataset.get_resources()][-4:] == [
+                "Concatenated COVID-19 Situation Report Data - Afghanistan (csv.gz)",
+                "Concatenated COVID-19 Situation Report Data - Afghanistan (parquet)",
+                "Joined COVID-19 Situation Report Data - Afghanistan (csv.gz)",
+                "Joined COVID-19 Situation Report Data - Afghanistan (parquet)",
+            ]
+            for name in ("concat", "joined"):
+                path = join(folder, "covid19sitrep_%s_afg" % name)
+                with open("%s.csv" % path, "rb") as input:
+                    csvlines = input.read().decode("utf-8").splitlines()
+                with gzip.open("%s.csv.gz" % path, "rb") as input:
+                    assert input.read().decode("utf-8").splitlines() == csvlines
+                table = pyarrow.parquet.read_table("%s.parquet" % path)
+                assert table.column_names == csvlines[0].split(",")
+                assert [field.metadata[b"hxl"].decode("utf-8") for field in table.schema] == csvlines[1].split(",")
+                assert [",".join(value or "" for value in row.values()) for row in table.to_pylist()] == csvlines[2:]
+        report = metrics.report()
+        assert {"write_csv.gz", "write_parquet"} <= set(report["stages"])
+        assert {"bytes_written_csv", "bytes_written_csv.gz", "bytes_written_parquet"} <= set(report["counters"])
+
+    @staticmethod
+    def world_downloader():
+        """Reports of AFG and AGO with the countries in a different order in each and a non-numeric value."""
+
+        def row(countryiso, indicator, timeperiod, value):
+            return {**TestScraperName.countrydata1[0], "REF_AREA": countryiso, "Geographic area": countryiso,
+                    "SITREP_INDICATOR": indicator, "TIME_PERIOD": timeperiod, "OBS_VALUE": value}
+
+        rows = {
+            "http://url1": [row("AGO", "CV-01-01", "2020-5-9", "x"), row("AFG", "CV-01-01", "2020-4-9", "2"),
+                            row("AGO", "CV-01-01", "2020-6-9", "1")],
+            "http://url2": [row("AFG", "CV-01-02", "2020-4-9", "3"), row("AFG", "CV-01-02", "2020-7-9", "4"),
+                            row("AGO", "CV-01-02", "2020-3-9", "5")],
+        }
+
+        class Downloader:
+            @staticmethod
+            def get_tabular_rows(url, *args, **kwargs):
+                return sorted(TestScraperName.countrydata1[0].keys()), rows[url]
+
+        return Downloader()
+
+    def test_joined_file_config_order(self, configuration, config):
+        """The joined csvs follow the order of the reports in the configuration, not their sorted order."""
+        config = dict(reversed(list(config.items())))
+        Locations.set_validlocations([{"name": name, "title": name} for name in ("afg", "ago", "world")])
+        countries, countriesdata, headers = get_all_countriesdata(config, self.world_downloader())
+        qc_indicators = [{"code": "CV-01-01"}]
+        with temp_dir("test_unicef_config_order", delete_if_exists=True) as folder:
+            for country in countries:
+                countrydata = countriesdata[country["iso3"]]
+                generate_dataset_and_showcase(folder, country, countrydata, headers, config, qc_indicators)
+                expected_rows, expected_headers = join_reports(countrydata, config)
+                assert expected_headers[4] == "observation_field2"
+                with open(join(folder, "covid19sitrep_joined_%s.csv" % country["iso3"].lower()), newline="") as input:
+                    reader = csv.reader(input)
+                    assert next(reader) == expected_headers
+                    next(reader)  # HXL row
+                    assert list(reader) == [
+                        [row.get(field) or "" for field in expected_headers] for row in expected_rows
+                    ]
+
+    @pytest.mark.parametrize("config_order", ["sorted", "reversed"])
+    def test_merge_world_files(self, configuration, config, config_order):
+        if config_order == "reversed":
+            config = dict(reversed(list(config.items())))
+        Locations.set_validlocations([{"name": name, "title": name} for name in ("afg", "ago", "world")])
+        countries, countriesdata, headers = get_all_countriesdata(config, self.world_downloader())
+        qc_indicators = [{"code": "CV-01-01"}, {"code": "CV-01-02"}]
+        world = [c for c in countries if c["iso3"] == "world"][0]
+        with temp_dir("test_unicef_merged", delete_if_exists=True) as merged, \
+                temp_dir("test_unicef", delete_if_exists=True) as folder:
+            # Only AFG was built: the csvs of AGO are written for the world
+            generate_dataset_and_showcase(merged, countries[0], countriesdata["AFG"], headers, config, qc_indicators)
+            dataset, _, bites_disabled = generate_dataset_and_showcase(
+                merged, world, countriesdata["world"], headers, config, qc_indicators, merge_countries={"AFG"}
+            )
+            expected, _, expected_bites_disabled = generate_dataset_and_showcase(
+                folder, world, countriesdata["world"], headers, config, qc_indicators
+            )
+            assert bites_disabled == expected_bites_disabled
+            assert dataset["dataset_date"] == expected["dataset_date"]
+            assert [resource.data for resource in dataset.get_resources()] == [
+                resource.data for resource in expected.get_resources()
+            ]
+            for resource in expected.get_resources():
+                filename = basename(resource.get_file_to_upload())
+                with open(join(merged, filename)) as input, open(join(folder, filename)) as expected_input:
+                    assert input.read() == expected_input.read()
+            expected_order = {
+                "sorted": ["AGO", "AGO", "AFG", "AFG", "AGO"], "reversed": ["AFG", "AFG", "AGO", "AGO", "AGO"]
+            }[config_order]
+            with open(join(merged, "covid19sitrep_joined_world.csv")) as input:
+                assert [line.split(",")[0] for line in input.read().splitlines()[2:]] == expected_order
+
+    @pytest.mark.parametrize("source", ["memory", "spooled", "store"])
+    def test_quickcharts_index(self, configuration, config, tmpdir, source):
+        Locations.set_validlocations([{"name": name, "title": name} for name in ("afg", "ago", "world")])
+        qc_indicators = [{"code": "CV-01-02"}, {"code": "CV-01-01"}, {"code": "CV-03-04"}]
+        qc_index = QuickChartsIndex(x["code"] for x in qc_indicators)
+        kwargs = dict()
+        if source == "spooled":
+            kwargs["spool_folder"] = join(str(tmpdir), "spool")
+        elif source == "store":
+            kwargs["store"] = ObservationStore(join(str(tmpdir), "observations.sqlite"))
+        countries, countriesdata, headers = get_all_countriesdata(
+            config, self.world_downloader(), qc_index=qc_index, **kwargs
+        )
+        if source == "store":
+            kwargs["store"].close()
+        assert sorted(qc_index.rows) == ["CV-01-01", "CV-01-02"]
+        assert [row["OBS_VALUE"] for row in qc_index.country("AGO").cutdown_rows()] == ["1", "5"]
+        # AGO comes first as it has the first row of CV-01-01, although its first numeric value comes after AFG's
+        assert [row["OBS_VALUE"] for row in qc_index.country("world").cutdown_rows()] == ["1", "2", "3", "4", "5"]
+        assert qc_index.country("AFG").bites_disabled() == [False, False, True]
+        with temp_dir("test_unicef_indexed", delete_if_exists=True) as indexed, \
+                temp_dir("test_unicef", delete_if_exists=True) as folder:
+            for country in countries:
+                countryiso = country["iso3"]
+                merge_countries = {"AFG", "AGO"} if countryiso == "world" else None
+                dataset, _, bites_disabled = generate_dataset_and_showcase(
+                    indexed, country, countriesdata[countryiso], headers, config, qc_indicators,
+                    merge_countries=merge_countries, qc_index=qc_index.country(countryiso)
+                )
+                expected, _, expected_bites_disabled = generate_dataset_and_showcase(
+                    folder, country, countriesdata[countryiso], headers, config, qc_indicators,
+                    merge_countries=merge_countries
+                )
+                assert bites_disabled == expected_bites_disabled
+                assert [resource.data for resource in dataset.get_resources()] == [
+                    resource.data for resource in expected.get_resources()
+                ]
+                for resource in expected.get_resources():
+                    filename = basename(resource.get_file_to_upload())
+                    with open(join(indexed, filename)) as input, open(join(folder, filename)) as expected_input:
+                        assert input.read() == expected_input.read()
+
+    def test_build_and_restore_dataset_and_showcase(self, configuration, downloader, config):
+        countries, countriesdata, headers = get_all_countriesdata(config, downloader)
+        country = [c for c in countries if c["iso3"] == "AFG"][0]
+        with temp_dir("test_unicef", delete_if_exists=True) as folder:
+            expected = generate_dataset_and_showcase(folder, country, countriesdata["AFG"], headers, config, [])
+            built, build_time, buildmetrics = build_dataset_and_showcase(
+                folder, country, countriesdata["AFG"], headers, config, []
+            )
+            dataset, showcase, bites_disabled = restore_dataset_and_showcase(pickle.loads(pickle.dumps(built)))
+        assert build_time > 0
+        assert sorted(buildmetrics["stages"]) == ["build", "join", "write_csv"]
+        assert buildmetrics["countries"]["AFG"]["counters"]["files_written"] == 5
+        assert buildmetrics["countries"]["AFG"]["counters"]["bytes_written_csv"] > 0
+        assert dataset.data == expected[0].data
+        assert [resource.data for resource in dataset.get_resources()] == [
+            resource.data for resource in expected[0].get_resources()
+        ]
+        assert [resource.get_file_to_upload() for resource in dataset.get_resources()] == [
+            resource.get_file_to_upload() for resource in expected[0].get_resources()
+        ]
+        assert showcase.data == expected[1].data
+        assert bites_disabled == expected[2]
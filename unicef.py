@@ -8,14 +8,33 @@ Reads UNICEF SAM COVID-19 csv and creates datasets.
 
 """
 
+import csv
+import gzip
+import hashlib
+import heapq
+import json
 import logging
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from io import TextIOWrapper
+from itertools import chain, islice
+from operator import itemgetter
+from os import makedirs, remove
+from os.path import exists, getsize, join, splitext
+from shutil import copyfileobj
+from sys import intern
+from threading import local
+from time import gmtime, perf_counter, sleep, strftime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
-from hdx.data.dataset import Dataset
-from hdx.data.hdxobject import HDXError
-from hdx.data.showcase import Showcase
-from hdx.location.country import Country
-from hdx.utilities.dictandlist import dict_of_lists_add
-from slugify import slugify
+from instrumentation import TimedIterator, add_time, capture, count, timer
+from registry import IndicatorRegistry, field_mappings
+
+# The HDX client (hdx.data), country tables, date parsing, slugify, pandas and pyarrow are slow to import so they are
+# imported where first used. Fetching and partitioning the data (eg. in a dry run) does not load them.
 
 logger = logging.getLogger(__name__)
 
@@ -38,21 +57,443 @@ hxltags = {
 }
 
 WORLD = "world"
+# Format of the fetch times recorded in the observation store (also used for the SDMX updatedAfter parameter)
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
+QC_CUTDOWN_HASHTAGS = ["#indicator+code", "#country+code", "#date", "#indicator+value+num"]
 
-def get_countriesdata(url, downloader, with_world=True):
-    """Fetch the countries data from an url and split them by country."""
-    headers, iterator = downloader.get_tabular_rows(url, dict_form=True)
-    countriesdata = dict()
+
+class WorldView(object):
+    """
+    Read only view over the rows of every country in countriesdata, in the order in which countries were first seen,
+    so that the world dataset does not need its own copy of all rows.
+    """
+
+    __slots__ = ("countriesdata",)
+
+    def __init__(self, countriesdata):
+        self.countriesdata = countriesdata
+
+    def __iter__(self):
+        for countryiso, rows in self.countriesdata.items():
+            if countryiso != WORLD:
+                yield from rows
+
+    def __len__(self):
+        return sum(len(rows) for countryiso, rows in self.countriesdata.items() if countryiso != WORLD)
+
+    def __bool__(self):
+        return any(rows for countryiso, rows in self.countriesdata.items() if countryiso != WORLD)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "WorldView(%d rows)" % len(self)
+
+
+class Row(Mapping):
+    """
+    Compact read only row: a tuple of values plus a column name to position index shared by all rows of a report.
+    It behaves like the dictionary rows returned by get_tabular_rows with dict_form=True.
+    """
+
+    __slots__ = ("columns", "values")
+
+    def __init__(self, columns, values):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.columns[key]]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __repr__(self):
+        return "Row(%s)" % dict(self.items())
+
+
+# Columns holding few distinct values (codes, names, units, dates) whose strings are interned so that rows share them
+UNINTERNED_COLUMNS = {"OBS_VALUE", "TARGET"}
+
+
+def tuple_getter(positions):
+    """Like itemgetter(*positions) but always returning a tuple, including for one or no positions."""
+    if not positions:
+        return lambda row: ()
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+    return itemgetter(*positions)
+
+
+def compact_rows(headers, iterator):
+    """
+    Convert rows from get_tabular_rows (in list or dict form) to Row objects sharing one column index. The strings of
+    the interned columns are gathered, interned with map and put back in place with itemgetters, which is faster than
+    a loop over the columns. Rows with values other than strings (eg. missing) take the slower path.
+    """
+    columns = {header: i for i, header in enumerate(headers)}
+    intern_positions = [i for i, header in enumerate(headers) if header not in UNINTERNED_COLUMNS]
+    other_positions = [i for i, header in enumerate(headers) if header in UNINTERNED_COLUMNS]
+    get_interned = tuple_getter(intern_positions)
+    get_others = tuple_getter(other_positions)
+    order = intern_positions + other_positions
+    reorder = tuple_getter(sorted(range(len(order)), key=order.__getitem__))
+    size = len(headers)
     for row in iterator:
+        if isinstance(row, Mapping):
+            row = [row.get(header) for header in headers]
+        elif len(row) != size:
+            row = (list(row) + [None] * size)[:size]
+        try:
+            values = list(map(intern, get_interned(row)))
+        except TypeError:
+            row = list(row)
+            for i in intern_positions:
+                value = row[i]
+                if type(value) is str:
+                    row[i] = intern(value)
+            yield Row(columns, tuple(row))
+            continue
+        values.extend(get_others(row))
+        yield Row(columns, reorder(values))
+
+
+class QuickChartsIndex(object):
+    """
+    Rows of the QuickCharts indicators that have numeric values, by indicator and then country in the order in which
+    the countries' rows (of any value) were downloaded, as in a WorldView. It is collected while rows are grouped by
+    country, so the QuickCharts cut down and bites of each dataset come from the index without another pass over the
+    data.
+    """
+
+    def __init__(self, qc_codes):
+        self.qc_codes = list(qc_codes)
+        self.codes = set(self.qc_codes)
+        self.rows = dict()
+
+    def add(self, row):
+        indicator = row["SITREP_INDICATOR"]
+        if indicator not in self.codes:
+            return
+        countries = self.rows.get(indicator)
+        if countries is None:
+            countries = self.rows[indicator] = dict()
+        # The country takes its place on its first row even if that row's value is not numeric
+        countryrows = countries.get(row["REF_AREA"])
+        if countryrows is None:
+            countryrows = countries[row["REF_AREA"]] = list()
+        try:
+            float(row["OBS_VALUE"])
+        except (TypeError, ValueError):
+            return
+        countryrows.append(row)
+
+    def clear(self):
+        self.rows = dict()
+
+    def update(self, other):
+        """Add the rows of another index (eg. of one download) after the rows of this one."""
+        for indicator, othercountries in other.rows.items():
+            countries = self.rows.setdefault(indicator, dict())
+            for countryiso, rows in othercountries.items():
+                countries.setdefault(countryiso, list()).extend(rows)
+
+    def country(self, countryiso):
+        """Index of the rows of one country (all countries for the world) to pass to generate_dataset_and_showcase."""
+        index = QuickChartsIndex(self.qc_codes)
+        for indicator, countries in self.rows.items():
+            if countryiso == WORLD:
+                index.rows[indicator] = countries
+            elif countryiso in countries:
+                index.rows[indicator] = {countryiso: countries[countryiso]}
+        return index
+
+    def bites_disabled(self):
+        bites_disabled = [True, True, True]
+        for i, code in enumerate(self.qc_codes):
+            if any(self.rows.get(code, {}).values()):
+                bites_disabled[i] = False
+        return bites_disabled
+
+    def cutdown_rows(self):
+        """
+        Rows of the QuickCharts csv: the rows of each indicator in code order (the order of the reports), by country.
+        A row goes in once for each time its indicator is in qc_codes.
+        """
+        for code in sorted(self.codes):
+            repeats = self.qc_codes.count(code)
+            for rows in self.rows.get(code, {}).values():
+                for row in rows:
+                    for _ in range(repeats):
+                        yield row
+
+
+def count_rows(name, countriesdata):
+    """Count the rows of each country (not the world) in countriesdata under the counter name."""
+    for countryiso, rows in countriesdata.items():
+        if countryiso != WORLD:
+            count(name, len(rows), countryiso)
+
+
+def get_countriesdata(url, downloader, with_world=True, qc_index=None, **kwargs):
+    """
+    Fetch the countries data from an url and split them by country. Rows of the QuickCharts indicators are added to
+    qc_index (a QuickChartsIndex) if given.
+    """
+    start = perf_counter()
+    headers, iterator = downloader.get_tabular_rows(url, dict_form=False, **kwargs)
+    setup_time = perf_counter() - start
+    iterator = TimedIterator(iterator)
+    start = perf_counter()
+    countriesdata = dict()
+    for row in compact_rows(headers, iterator):
         countryiso3 = row["REF_AREA"]
-        countriesdata[countryiso3] = countriesdata.get(countryiso3, []) + [row]
-        if with_world:
-            countriesdata[WORLD] = countriesdata.get(WORLD, []) + [row]
+        countryrows = countriesdata.get(countryiso3)
+        if countryrows is None:
+            countriesdata[countryiso3] = [row]
+        else:
+            countryrows.append(row)
+        if qc_index is not None:
+            qc_index.add(row)
+    add_time("download", setup_time + iterator.seconds)
+    add_time("group", perf_counter() - start - iterator.seconds)
+    count_rows("rows_downloaded", countriesdata)
+    if with_world and countriesdata:
+        countriesdata[WORLD] = WorldView(countriesdata)
 
     return countriesdata, headers
 
 
+class PartitionRows(object):
+    """Re-iterable rows of one situation report for one country, read back from its partition file on demand."""
+
+    __slots__ = ("path", "count")
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+    def __iter__(self):
+        with open(self.path, newline="", encoding="utf-8") as input:
+            reader = csv.reader(input)
+            yield from compact_rows(next(reader), reader)
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "PartitionRows(%s, %d rows)" % (self.path, self.count)
+
+
+def open_partition(folder, countryiso, headers):
+    """
+    Start a country's partition csv in folder with the header row. Returns the open file, a csv writer on it and the
+    PartitionRows that read it back (whose count is to be incremented for each row written).
+    """
+    makedirs(folder, exist_ok=True)
+    path = join(folder, "%s.csv" % countryiso)
+    output = open(path, "w", newline="", encoding="utf-8")
+    writer = csv.writer(output)
+    writer.writerow(headers)
+    return output, writer, PartitionRows(path, 0)
+
+
+def close_partitions(partitions):
+    """Close the files of partitions opened by open_partition and forget them."""
+    for output, _, _ in partitions.values():
+        output.close()
+    partitions.clear()
+
+
+def spool_countriesdata(url, downloader, folder, with_world=True, qc_index=None, **kwargs):
+    """
+    Fetch the countries data from an url, writing each country's rows to its own csv partition in folder instead of
+    keeping them in memory. Returns the same structure as get_countriesdata with rows read lazily from the partitions.
+    Rows of the QuickCharts indicators (a small part of the data) are kept in qc_index if given.
+    """
+    start = perf_counter()
+    headers, iterator = downloader.get_tabular_rows(url, dict_form=False, **kwargs)
+    setup_time = perf_counter() - start
+    iterator = TimedIterator(iterator)
+    start = perf_counter()
+    files = dict()
+    countriesdata = dict()
+    try:
+        for row in compact_rows(headers, iterator):
+            countryiso3 = row["REF_AREA"]
+            partition = files.get(countryiso3)
+            if partition is None:
+                partition = files[countryiso3] = open_partition(folder, countryiso3, headers)
+                countriesdata[countryiso3] = partition[2]
+            partition[1].writerow(row.values)
+            partition[2].count += 1
+            if qc_index is not None:
+                qc_index.add(row)
+    finally:
+        close_partitions(files)
+    add_time("download", setup_time + iterator.seconds)
+    add_time("spool", perf_counter() - start - iterator.seconds)
+    count_rows("rows_downloaded", countriesdata)
+    if with_world and countriesdata:
+        countriesdata[WORLD] = WorldView(countriesdata)
+
+    return countriesdata, headers
+
+
+def fetch_report(report_id, url, downloader, with_world=True, timeout=None, retries=0, backoff=1.0, spool_folder=None,
+                 qc_index=None):
+    """
+    Fetch and split the data of one situation report, retrying failed downloads after backoff * 2 ** n seconds.
+    Rows are spooled to a subfolder of spool_folder named after the report and added to qc_index if given.
+    """
+    kwargs = dict()
+    if timeout is not None:
+        kwargs["http_timeout"] = timeout
+    attempt = 0
+    while True:
+        logger.info("Getting situation report %s" % report_id)
+        if qc_index is not None:
+            qc_index.clear()
+        try:
+            with timer("fetch"):
+                if spool_folder:
+                    return spool_countriesdata(url, downloader, join(spool_folder, report_id), with_world, qc_index,
+                                               **kwargs)
+                return get_countriesdata(url, downloader, with_world, qc_index, **kwargs)
+        except Exception as ex:
+            if attempt >= retries:
+                raise
+            wait = backoff * 2 ** attempt
+            attempt += 1
+            logger.warning("Getting situation report %s failed (%s). Retry %d of %d in %.1fs" % (
+                report_id, ex, attempt, retries, wait))
+            sleep(wait)
+
+
+def delta_url(url, **parameters):
+    """Add SDMX query parameters (eg. startPeriod) to url, replacing any it already has."""
+    spliturl = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(spliturl.query, keep_blank_values=True) if key not in parameters]
+    query.extend(parameters.items())
+    return urlunsplit(spliturl._replace(query=urlencode(query, safe=",:")))
+
+
+def delta_parameters(store, report_id, incremental, fetched_at=None, full_fetch_days=None):
+    """
+    SDMX query parameters requesting what changed since a report's last fetch recorded in store (see
+    incremental_fetch), or None if the full history is needed, including when the last full fetch is more than
+    full_fetch_days before fetched_at (now by default).
+    """
+    last_fetch = store.last_fetch(report_id)
+    if not last_fetch:
+        return None
+    last_fetched_at, latest_period, full_fetched_at = last_fetch
+    if full_fetch_days is not None:
+        now = datetime.strptime(fetched_at, TIMESTAMP_FORMAT) if fetched_at else datetime.utcnow()
+        if not full_fetched_at or \
+                now - datetime.strptime(full_fetched_at, TIMESTAMP_FORMAT) > timedelta(days=full_fetch_days):
+            logger.info("Last full fetch of situation report %s is over %s days old" % (report_id, full_fetch_days))
+            return None
+    if incremental == "updatedAfter":
+        return {"updatedAfter": last_fetched_at}
+    if latest_period:
+        return {"startPeriod": latest_period}
+    return None
+
+
+def group_requests(urls, config, max_length=None):
+    """
+    Group the urls of reports that differ only in the indicator at the end of the SDMX key into requests for several
+    indicators (eg. .../.CV-01-01+CV-01-02?format=csv) of at most max_length characters. Returns a list of (report
+    ids, url, indicators mapping SITREP_INDICATOR to report id or None for a single report).
+    """
+    requests = list()
+    batches = dict()
+    for report_id, url in urls.items():
+        identifier = config[report_id].get("identifier")
+        spliturl = urlsplit(url)
+        path = spliturl.path
+        if not max_length or not identifier or not path.endswith(identifier) or \
+                path[-len(identifier) - 1:-len(identifier)] not in ("/", "."):
+            requests.append(([report_id], url, None))
+            continue
+        prefix = spliturl._replace(path=path[:-len(identifier)])
+        batch = batches.get(prefix)
+        if batch is not None:
+            batchurl = urlunsplit(prefix._replace(path="%s+%s" % (urlsplit(batch[1]).path, identifier)))
+            if len(batchurl) <= max_length:
+                batch[0].append(report_id)
+                batch[1] = batchurl
+                batch[2][identifier] = report_id
+                continue
+        batch = batches[prefix] = [[report_id], url, {identifier: report_id}]
+        requests.append(batch)
+    return [(report_ids, url, indicators if len(report_ids) > 1 else None)
+            for report_ids, url, indicators in requests]
+
+
+def demultiplex(countriesdata, headers, indicators, with_world=True, spool_folder=None):
+    """
+    Split the countriesdata of a multi-indicator request into the countriesdata of each report by SITREP_INDICATOR.
+    indicators maps SITREP_INDICATOR to report id. Spooled rows are spooled again to per-report partitions in
+    spool_folder. Returns a dictionary of report id to (countriesdata, headers) as returned by get_countriesdata.
+    """
+    reports = {report_id: dict() for report_id in indicators.values()}
+    files = dict()
+    unknown = set()
+    try:
+        for countryiso, rows in countriesdata.items():
+            if countryiso == WORLD:
+                continue
+            for row in rows:
+                indicator = row["SITREP_INDICATOR"]
+                report_id = indicators.get(indicator)
+                if report_id is None:
+                    unknown.add(indicator)
+                    continue
+                reportdata = reports[report_id]
+                if spool_folder is None:
+                    countryrows = reportdata.get(countryiso)
+                    if countryrows is None:
+                        reportdata[countryiso] = [row]
+                    else:
+                        countryrows.append(row)
+                    continue
+                partition = files.get(report_id)
+                if partition is None:
+                    partition = files[report_id] = open_partition(join(spool_folder, report_id), countryiso, headers)
+                    reportdata[countryiso] = partition[2]
+                partition[1].writerow(row.values)
+                partition[2].count += 1
+            # Rows are grouped by country, so only one country's partitions are open at a time
+            close_partitions(files)
+    finally:
+        close_partitions(files)
+    if unknown:
+        logger.warning("Rows for unconfigured indicators %s ignored" % ", ".join(sorted(unknown)))
+    for reportdata in reports.values():
+        if with_world and reportdata:
+            reportdata[WORLD] = WorldView(reportdata)
+    return {report_id: (reportdata, headers) for report_id, reportdata in reports.items()}
+
+
+@lru_cache(maxsize=None)
+def country_name(countryiso):
+    """Name of a country from its iso3 code (looked up once per run)."""
+    from hdx.location.country import Country
+
+    return Country.get_country_name_from_iso3(countryiso)
+
+
 def countries_from_iso_list(countriesset):
     """
     Create a list of dictionaries describing each country in the countriesset.
@@ -64,84 +505,405 @@ def countries_from_iso_list(countriesset):
         if countryiso == WORLD:
             countries.append({"iso3": WORLD, "name": "World"})
         else:
-            countryname = Country.get_country_name_from_iso3(countryiso)
+            countryname = country_name(countryiso)
             if countryname is None:
                 continue
             countries.append({"iso3": countryiso, "name": countryname})
     return countries
 
 
-def get_all_countriesdata(config, downloader, with_world=True):
+def build_requests(config, batch_url_length=None, store=None, incremental=None, fetched_at=None,
+                   full_fetch_days=None):
+    """
+    Requests (see group_requests) for the reports in config and the set of ids of the reports requested as deltas of
+    what is in store (see delta_parameters).
+    """
+    urls = dict()
+    deltas = set()
+    for report_id, report_config in config.items():
+        url = report_config["url"]
+        parameters = None
+        if store is not None and incremental:
+            parameters = delta_parameters(store, report_id, incremental, fetched_at, full_fetch_days)
+        if parameters:
+            url = delta_url(url, **parameters)
+            deltas.add(report_id)
+        urls[report_id] = url
+    return group_requests(urls, config, batch_url_length), deltas
+
+
+def fetch_request(request, downloader, with_world=True, timeout=None, retries=0, backoff=1.0, spool_folder=None,
+                  qc_codes=None):
+    """
+    Fetch one request of build_requests, splitting a multi-indicator request back into reports. Returns a list of
+    (report id, (countriesdata, headers), index) where index (for the first report only) is a QuickChartsIndex of the
+    request's rows of qc_codes, if given.
+    """
+    collected = QuickChartsIndex(qc_codes) if qc_codes is not None else None
+    report_ids, url, indicators = request
+    if indicators is None:
+        report_id = report_ids[0]
+        return [(report_id, fetch_report(report_id, url, downloader, with_world, timeout, retries, backoff,
+                                         spool_folder, collected), collected)]
+    request_id = batch_id(report_ids)
+    logger.info("Getting situation reports %s in one request (%s)" % (", ".join(report_ids), request_id))
+    batchdata, batchheaders = fetch_report(request_id, url, downloader, False, timeout, retries, backoff,
+                                           spool_folder, collected)
+    reports = demultiplex(batchdata, batchheaders, indicators, with_world,
+                          join(spool_folder, request_id) if spool_folder else None)
+    return [(report_id, reports[report_id], collected if i == 0 else None) for i, report_id in enumerate(report_ids)]
+
+
+def batch_id(report_ids):
+    """
+    Short id of a request for several reports, naming its spool folder. It does not grow with the number of reports
+    so that the folder name stays within filename length limits.
+    """
+    return "batch_%s" % hashlib.sha1("+".join(report_ids).encode("utf-8")).hexdigest()[:12]
+
+
+def fetch_with_fallback(request, get_downloader, config, deltas, batch_url_length=None, **kwargs):
+    """
+    fetch_request with a downloader from get_downloader, adding whether each report's data is complete (False for a
+    delta). If the delta fetch of reports in deltas fails, their full history is fetched instead.
+    """
+    report_ids = request[0]
+    requests = [request]
+    if report_ids[0] in deltas:
+        try:
+            results = fetch_request(request, get_downloader(), **kwargs)
+            count("delta_fetches")
+            return [(report_id, data, False, collected) for report_id, data, collected in results]
+        except Exception as ex:
+            logger.warning("Delta fetch of situation reports %s failed (%s). Fetching full history" % (
+                ", ".join(report_ids), ex))
+        requests, _ = build_requests({report_id: config[report_id] for report_id in report_ids}, batch_url_length)
+    return [(report_id, data, True, collected) for fullrequest in requests
+            for report_id, data, collected in fetch_request(fullrequest, get_downloader(), **kwargs)]
+
+
+class ThreadDownloaders(object):
+    """Downloaders created by factory, one per thread on its first use, as a Download must not be shared."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = local()
+        self.downloaders = list()
+
+    def get(self):
+        downloader = getattr(self.local, "downloader", None)
+        if downloader is None:
+            downloader = self.local.downloader = self.factory()
+            self.downloaders.append(downloader)
+        return downloader
+
+    def close(self):
+        for downloader in self.downloaders:
+            downloader.close()
+
+
+def map_requests(fetch, requests, downloader, fetch_workers=1, downloader_factory=None):
+    """
+    Results of fetch(request, get_downloader) for each request, using downloader or with fetch_workers > 1, a
+    downloader from downloader_factory per worker thread.
+    """
+    fetch_workers = max(1, min(fetch_workers, len(requests)))
+    if fetch_workers > 1 and downloader_factory is None:
+        logger.warning("No downloader_factory to create a downloader per worker. Getting situation reports with 1 "
+                       "worker instead of %d" % fetch_workers)
+        fetch_workers = 1
+    if fetch_workers == 1:
+        return [fetch(request, lambda: downloader) for request in requests]
+    logger.info("Getting situation reports in %d requests using %d workers" % (len(requests), fetch_workers))
+    downloaders = ThreadDownloaders(downloader_factory)
+    try:
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            return list(executor.map(partial(fetch, get_downloader=downloaders.get), requests))
+    finally:
+        downloaders.close()
+
+
+def store_report(store, report_id, reportdata, complete, fetched_at, with_world=True):
+    """
+    Upsert the rows of a fetched report into store. Returns the report's (countriesdata, headers) queried from it,
+    counting its stored rows as rows_stored.
+    """
+    report_countriesdata, report_headers = reportdata
+    with timer("store"):
+        store.update_report(report_id, report_headers, (
+            row for countryiso, rows in report_countriesdata.items() if countryiso != WORLD for row in rows
+        ), complete, fetched_at)
+        reportdata = store.countriesdata(report_id, with_world)
+    count_rows("rows_stored", reportdata[0])
+    return reportdata
+
+
+def index_stored_rows(store, qc_index, report_ids):
+    """Fill qc_index with the rows of its indicators in store (a delta fetch only has some of the rows)."""
+    with timer("store"):
+        qc_index.clear()
+        for report_id in report_ids:
+            for code in dict.fromkeys(qc_index.qc_codes):
+                for row in store.query(report_id, indicator=code):
+                    qc_index.add(row)
+
+
+def merge_reports(config, reports):
+    """Merge the (countriesdata, headers) of each report by country in config order as get_all_countriesdata."""
     countriesset = set()
     countriesdata = {}
     headers = {}
-    for report_id, report_config in config.items():
-        logger.info("Getting situation report %s" % report_id)
-        url = report_config["url"]
-        report_countriesdata, report_headers = get_countriesdata(url, downloader)
+    for report_id in config:
+        report_countriesdata, report_headers = reports.pop(report_id)
         countriesset.update(report_countriesdata.keys())
         headers[report_id] = report_headers
         for countryiso, data in report_countriesdata.items():
-            countriesdata[countryiso] = countriesdata.get(countryiso,{})
+            countriesdata[countryiso] = countriesdata.get(countryiso, {})
             countriesdata[countryiso][report_id] = data
-
     return countries_from_iso_list(countriesset), countriesdata, headers
 
-def concat_reports(countrydata):
-    key_fields = [
-        "REF_AREA",
-        "Geographic area",
-        "SITREP_INDICATOR",
-        "Situation Report Indicator",
-        "HAC_PILLAR",
-        "Humanitarian Action for Children Pillar",
-        "UNIT_MEASURE",
-        "Unit of measure",
-        "TIME_PERIOD",
-        "OBS_VALUE",
-        "DATA_SOURCE",
-        "TARGET",
-        "OBS_STATUS",
-        "Observation status"
-    ]
-    headers = key_fields[:]
 
-    rows = []
-    for report_id in sorted(countrydata.keys()):
-        report_rows = countrydata[report_id]
-        for report_row in report_rows:
-            rows.append(report_row)
-            for field in sorted(report_row.keys()):
-                if field not in headers:
-                    headers.append(field)
+def get_all_countriesdata(config, downloader, with_world=True, fetch_workers=1, timeout=None, retries=0, backoff=1.0,
+                          downloader_factory=None, spool_folder=None, store=None, incremental=None,
+                          batch_url_length=None, qc_index=None, full_fetch_days=None):
+    """
+    Fetch all situation reports in config and merge them by country in config order. downloader_factory gives each
+    of fetch_workers threads its own downloader. If given, rows are spooled to spool_folder, kept in store (an
+    ObservationStore, fetching only deltas if incremental is set) and fetched in batched requests of at most
+    batch_url_length characters. The rows of qc_index's indicators are added to it.
+    """
+    fetched_at = strftime(TIMESTAMP_FORMAT, gmtime())
+    requests, deltas = build_requests(config, batch_url_length, store, incremental, fetched_at, full_fetch_days)
+    # The QuickCharts rows of each request are collected separately then added to qc_index in config order. With a
+    # store, they are queried from it instead as a delta fetch only has some of the rows.
+    qc_codes = qc_index.qc_codes if qc_index is not None and store is None else None
+    fetch = partial(fetch_with_fallback, config=config, deltas=deltas, batch_url_length=batch_url_length,
+                    with_world=with_world, timeout=timeout, retries=retries, backoff=backoff,
+                    spool_folder=spool_folder, qc_codes=qc_codes)
+    results = map_requests(fetch, requests, downloader, fetch_workers, downloader_factory)
+
+    # Each report's data (queried from the store if there is one) is merged in config order once all are fetched
+    reports = dict()
+    for requestresults in results:
+        for report_id, reportdata, complete, collected in requestresults:
+            if collected is not None:
+                qc_index.update(collected)
+            if store is not None:
+                reportdata = store_report(store, report_id, reportdata, complete, fetched_at, with_world)
+            reports[report_id] = reportdata
+    if store is not None and qc_index is not None:
+        index_stored_rows(store, qc_index, config)
+    return merge_reports(config, reports)
+
 
-    return rows, headers
+CONCAT_KEY_FIELDS = [
+    "REF_AREA",
+    "Geographic area",
+    "SITREP_INDICATOR",
+    "Situation Report Indicator",
+    "HAC_PILLAR",
+    "Humanitarian Action for Children Pillar",
+    "UNIT_MEASURE",
+    "Unit of measure",
+    "TIME_PERIOD",
+    "OBS_VALUE",
+    "DATA_SOURCE",
+    "TARGET",
+    "OBS_STATUS",
+    "Observation status",
+]
+
+
+def concat_headers(report_ids, headers):
+    """
+    Headers of the concatenation of the given reports: the key fields followed by the remaining fields of each report
+    (in sorted report and then field order), worked out once from the headers of each report.
+    """
+    concatheaders = CONCAT_KEY_FIELDS[:]
+    index = set(concatheaders)
+    for report_id in sorted(report_ids):
+        for field in sorted(headers[report_id]):
+            if field not in index:
+                index.add(field)
+                concatheaders.append(field)
+    return concatheaders
+
+
+def concat_reports(countrydata, headers=None):
+    """
+    Concatenate the rows of all reports in sorted report order. Returns the headers and an iterator yielding the rows
+    lazily, so no copy of the data is made. Column order comes from the report headers if given (as returned by
+    get_tabular_rows), otherwise from the fields of the first row of each report.
+    """
+    if headers is None:
+        headers = {report_id: next(iter(report_rows), {}).keys() for report_id, report_rows in countrydata.items()}
+    rows = chain.from_iterable(countrydata[report_id] for report_id in sorted(countrydata.keys()))
+    return rows, concat_headers(countrydata.keys(), headers)
+
+
+class ReportJoiner(object):
+    """
+    Joins the observation and target values of rows from several reports one row at a time. If report_ids is given,
+    the reports can be added in any order (all the rows of one report after another) and are joined as if they had
+    been added in the order of report_ids.
+    """
 
-def join_reports(countrydata, config):
     key_fields = ["REF_AREA", "Geographic area", "TIME_PERIOD", "DATA_SOURCE"]
-    data = {}
+
+    def __init__(self, config, report_ids=None):
+        self.config = config
+        self.data = {}
+        self.mappings = {}
+        self.positions = None
+        self.shared = frozenset()
+        if report_ids is not None:
+            self.positions = {report_id: position for position, report_id in enumerate(report_ids)}
+            # Keys in the order of the rows of the report they were first seen in, and the position of the first
+            # report (in report_ids order) that has each key
+            self.keyorders = [[] for _ in self.positions]
+            self.firstpositions = {}
+            # Fields that several reports map to, whose values are only replaced by those of later reports
+            destination_fields = [destination_field for report_id in self.positions
+                                  for destination_field, _ in field_mappings(config, report_id)]
+            self.shared = frozenset(field for field in destination_fields if destination_fields.count(field) > 1)
+            self.valuepositions = {}
+
+    @property
+    def headers(self):
+        """Key fields followed by the fields of the reports with rows, complete once all rows have been added."""
+        report_ids = self.mappings if self.positions is None else sorted(self.mappings, key=self.positions.get)
+        headers = self.key_fields[:]
+        for report_id in report_ids:
+            for destination_field, _ in self.mappings[report_id]:
+                if destination_field not in headers:
+                    headers.append(destination_field)
+        return headers
+
+    def add(self, report_id, report_row):
+        mappings = self.mappings.get(report_id)
+        if mappings is None:
+            # Look up a report's fields once, on its first row
+            mappings = self.mappings[report_id] = field_mappings(self.config, report_id)
+        key = tuple(report_row[field] for field in self.key_fields)
+        joined_row = self.data.get(key)
+        if joined_row is None:
+            joined_row = self.data[key] = {}
+        if self.positions is None:
+            for destination_field, source_field in mappings:
+                joined_row[destination_field] = report_row[source_field]
+            return
+        position = self.positions[report_id]
+        if self.firstpositions.get(key, position + 1) > position:
+            self.firstpositions[key] = position
+            self.keyorders[position].append(key)
+        for destination_field, source_field in mappings:
+            if destination_field in self.shared:
+                if self.valuepositions.get((key, destination_field), position) > position:
+                    continue
+                self.valuepositions[(key, destination_field)] = position
+            joined_row[destination_field] = report_row[source_field]
+
+    def rows(self):
+        """Yield the joined rows in first seen key order."""
+        key_fields = self.key_fields
+        if self.positions is None:
+            keys = self.data
+        else:
+            firstpositions = self.firstpositions
+            keys = (key for position, keyorder in enumerate(self.keyorders) for key in keyorder
+                    if firstpositions[key] == position)
+        for key_values in keys:
+            yield {**dict(zip(key_fields, key_values)), **self.data[key_values]}
+
+
+@lru_cache(maxsize=None)
+def import_pandas():
+    """Import numpy and pandas on first use. Returns None, None if pandas is not installed."""
+    try:
+        import numpy
+        import pandas
+    except ImportError:
+        return None, None
+    return numpy, pandas
+
+
+def join_reports_pandas(countrydata, config):
+    """
+    Vectorized join_reports. Each report's key and value columns are loaded into a DataFrame, distinct keys are
+    numbered in the order they are first seen and the values are scattered into a keys by fields table. Output is the
+    same as join_reports: first seen key order and the last value wins for repeated keys.
+    """
+    np, pd = import_pandas()
+    key_fields = ReportJoiner.key_fields
     headers = key_fields[:]
+    keyframes = []
+    fieldvalues = []
+    offset = 0
+    for report_id, report_rows in countrydata.items():
+        mappings = field_mappings(config, report_id)
+        sources = sorted(set(source_field for _, source_field in mappings))
+        report_rows = list(report_rows)
+        frame = pd.DataFrame(
+            {field: [row.get(field) for row in report_rows] for field in key_fields + sources},
+            columns=key_fields + sources,
+        )
+        if len(frame) == 0:
+            continue
+        keyframes.append(frame[key_fields])
+        for destination_field, source_field in mappings:
+            if destination_field not in headers:
+                headers.append(destination_field)
+            positions = np.arange(offset, offset + len(frame))
+            fieldvalues.append((headers.index(destination_field), positions, frame[source_field].to_numpy(dtype=object)))
+        offset += len(frame)
+    if not keyframes:
+        return iter(()), headers
+    keys = pd.concat(keyframes, ignore_index=True)
+    # Number each distinct key in the order it is first seen
+    codes = keys.groupby(key_fields, sort=False, dropna=False).ngroup().to_numpy()
+    uniquekeys = keys.loc[~pd.Index(codes).duplicated()]
+    table = np.empty((len(uniquekeys), len(headers)), dtype=object)
+    table[:, :len(key_fields)] = uniquekeys.to_numpy(dtype=object)
+    present = np.zeros(table.shape, dtype=bool)
+    present[:, :len(key_fields)] = True
+    for column, positions, values in fieldvalues:
+        rowcodes = codes[positions]
+        last = ~pd.Index(rowcodes).duplicated(keep="last")
+        table[rowcodes[last], column] = values[last]
+        present[rowcodes[last], column] = True
+    return pandas_joined_rows(headers, table, present), headers
 
+
+def pandas_joined_rows(headers, table, present):
+    """
+    Yield the rows of the joined table one at a time. Fields not set for a key are left out of its row, as in the
+    Python join.
+    """
+    for values, isset in zip(table, present):
+        yield {field: value for field, value, fieldset in zip(headers, values.tolist(), isset.tolist()) if fieldset}
+
+
+def join_reports(countrydata, config, engine="python"):
+    """
+    Join the observation and target values of all reports on REF_AREA, Geographic area, TIME_PERIOD and DATA_SOURCE.
+    Returns the headers and an iterator yielding the joined rows lazily (the headers are complete before the first
+    row). engine can be "pandas" to use the vectorized join, falling back to the pure Python join if pandas is not
+    installed.
+    """
+    if engine == "pandas":
+        if import_pandas()[1] is not None:
+            return join_reports_pandas(countrydata, config)
+        logger.warning("pandas is not installed. Using the Python join engine")
+    joiner = ReportJoiner(config)
     for report_id, report_rows in countrydata.items():
         for report_row in report_rows:
-            report_config = config.get(report_id,{})
-            key = tuple(report_row[field] for field in key_fields)
-            joined_row = data.get(key, {})
-            for field_type, source_field in (("observation_field", "OBS_VALUE"), ("target_field", "TARGET")):
-                if field_type in report_config:
-                    destination_field = report_config[field_type]
-                    joined_row[destination_field] = report_row[source_field]
-                    if destination_field not in headers:
-                        headers.append(destination_field)
-            data[key]=joined_row
-
-    rows = []
-    for key_values, joined_values in data.items():
-        row_key = dict(zip(key_fields, key_values))
-        rows.append({**row_key, **joined_values})
-    return rows, headers
+            joiner.add(report_id, report_row)
+    return joiner.rows(), joiner.headers
+
 
 def hxltags_from_config(config):
+    if isinstance(config, IndicatorRegistry):
+        return dict(config.hxltags)
     hxltags={}
     for report_config in config.values():
         for field in ("observation_field", "target_field"):
@@ -151,144 +913,703 @@ def hxltags_from_config(config):
     return hxltags
 
 
-def generate_dataset_and_showcase(folder, country, countrydata, headers, config, qc_indicators):
-    countryname = country["name"]
-    countryiso = country["iso3"].lower()
-    if countryiso == WORLD:
-        title = "Global COVID-19 Situation Report"
-    else:
-        title = "%s - COVID-19 Situation Report" % country["name"]
-    logger.info("Creating dataset: %s" % title)
-    name = "UNICEF COVID-19 situation report for %s" % country["name"]
-    slugified_name = slugify(name).lower()
-    dataset = Dataset({"name": slugified_name, "title": title})
-    dataset.set_maintainer("196196be-6037-4488-8b71-d786adf4c081")
-    dataset.set_organization("3ab17ac1-1196-4501-a4dc-a01d2e52ff7c")
-    dataset.set_subnational(False)
-    dataset.set_expected_update_frequency("Every month")
-    dataset.add_tags(
-        [
-            "hxl",
-            "children",
-            "COVID-19",
-            "malnutrition",
-            "hygiene",
-            "health",
-            "healthcare",
+# Size of the write buffer of output files
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Number of rows the writers of the other output formats collect before writing them out
+OUTPUT_BATCH_ROWS = 10000
+
+
+@lru_cache(maxsize=None)
+def import_pyarrow():
+    """Import pyarrow and its parquet module on first use. Returns None, None if pyarrow is not installed."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None, None
+    return pyarrow, pyarrow.parquet
+
+
+class BatchWriter(object):
+    """
+    Copy of a resource csv in another format, written in batches of rows. Subclasses open output and define
+    write(rows) to write a batch. Writing a batch (and closing) is timed as the write_<format> stage.
+    """
+
+    format = None
+
+    def __init__(self, path, headers, hxltags):
+        self.path = path
+        self.headers = headers
+        self.hxltags = hxltags
+        self.batch = list()
+
+    def writerow(self, values):
+        self.batch.append(values)
+        if len(self.batch) == OUTPUT_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            with timer("write_%s" % self.format):
+                self.write(self.batch)
+            self.batch = list()
+
+    def close(self):
+        self.flush()
+        with timer("write_%s" % self.format):
+            self.output.close()
+
+
+class GzipCsvWriter(BatchWriter):
+    """Gzip compressed csv identical to the resource csv (header row, HXL row then data rows) once decompressed."""
+
+    format = "csv.gz"
+    file_type = "gzip"
+
+    def __init__(self, path, headers, hxltags):
+        super().__init__(path, headers, hxltags)
+        # mtime=0 so that the same rows always give the same file
+        self.output = TextIOWrapper(
+            gzip.GzipFile(path, "wb", compresslevel=6, mtime=0), encoding="utf-8", newline=""
+        )
+        self.writer = csv.writer(self.output)
+        self.batch = [headers, [hxltags.get(header, "") for header in headers]]
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+
+class ParquetWriter(BatchWriter):
+    """
+    Parquet file with the columns of the resource csv, in the same order, as strings with empty values as nulls. The
+    HXL hashtag of each column is kept in the column's metadata (under hxl) since Parquet has no place for an HXL row.
+    """
+
+    format = "parquet"
+    file_type = "parquet"
+
+    def __init__(self, path, headers, hxltags):
+        super().__init__(path, headers, hxltags)
+        pa, pq = import_pyarrow()
+        self.schema = pa.schema(
+            [pa.field(header, pa.string(), metadata={"hxl": hxltags.get(header, "")}) for header in headers]
+        )
+        self.output = pq.ParquetWriter(path, self.schema, compression="snappy")
+
+    def write(self, rows):
+        pa, _ = import_pyarrow()
+        columns = [
+            pa.array([None if value is None or value == "" else str(value) for value in column], pa.string())
+            for column in zip(*rows)
         ]
-    )
+        self.output.write_table(pa.Table.from_arrays(columns, schema=self.schema))
 
-    if countryiso == WORLD:
-        dataset.add_other_location("world")
-    else:
+
+OUTPUT_WRITERS = {writer.format: writer for writer in (GzipCsvWriter, ParquetWriter)}
+
+
+def output_writers(output_formats):
+    """Writers for output_formats (other than csv), leaving out unknown formats and formats needing missing packages."""
+    writers = list()
+    for output_format in output_formats or ():
+        if output_format == "csv":
+            continue
+        writer = OUTPUT_WRITERS.get(output_format)
+        if writer is None:
+            logger.warning("Unknown output format %s. Expected one of %s" % (output_format, ", ".join(OUTPUT_WRITERS)))
+        elif writer is ParquetWriter and import_pyarrow()[0] is None:
+            logger.warning("pyarrow is not installed. Not writing parquet files")
+        else:
+            writers.append(writer)
+    return writers
+
+
+class ResourceFile(object):
+    """
+    Resource csv (header row, HXL row then data rows) written one row at a time, keeping track of the date range of
+    the rows written. The rows are also written to a file for each of writers (classes of BatchWriter), named after
+    the csv with the writer's format as extension.
+    """
+
+    def __init__(self, folder, filename, headers, hxltags, resourcedata, writers=()):
+        self.filename = filename
+        self.path = join(folder, filename)
+        self.headers = headers
+        self.resourcedata = resourcedata
+        self.rows = 0
+        self.startdate = None
+        self.enddate = None
+        self.output = open(self.path, "w", newline="", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
+        self.writer = csv.writer(self.output)
+        self.writer.writerow(headers)
+        self.writer.writerow([hxltags.get(header, "") for header in headers])
+        base = splitext(self.path)[0]
+        self.writers = [writer("%s.%s" % (base, writer.format), headers, hxltags) for writer in writers]
+        self.added = False
+
+    def writerow(self, row, date=None):
+        values = [row.get(header) for header in self.headers]
+        self.writer.writerow(values)
+        for writer in self.writers:
+            writer.writerow(values)
+        self.rows += 1
+        if date is not None:
+            self.add_dates(date, date)
+
+    def add_dates(self, startdate, enddate):
+        if self.startdate is None or startdate < self.startdate:
+            self.startdate = startdate
+        if self.enddate is None or enddate > self.enddate:
+            self.enddate = enddate
+
+    def close(self):
+        if self.output.closed:
+            return
+        self.output.close()
+        for writer in self.writers:
+            writer.close()
+
+    def copy_rows(self, path, rows):
+        """Append the data rows of the csv at path, written by a ResourceFile with the same headers, to the file."""
+        with open(path, newline="", encoding="utf-8") as input:
+            input.readline()
+            input.readline()
+            copyfileobj(input, self.output)
+        self.rows += rows
+
+    def sizes(self):
+        """Size of the file written in each format."""
+        sizes = {"csv": getsize(self.path)}
+        for writer in self.writers:
+            sizes[writer.format] = getsize(writer.path)
+        return sizes
+
+    def add_to_dataset(self, dataset, check_dates=True, allow_empty=False):
+        """
+        Add the file as a resource of the dataset if it has data rows (unless allow_empty) and dates (if check_dates).
+        Returns whether it was added.
+        """
+        self.close()
+        if self.rows == 0 and not allow_empty:
+            logger.error("No data rows in %s!" % self.filename)
+            return False
+        if check_dates and self.startdate is None:
+            logger.error("No dates in %s!" % self.filename)
+            return False
+        from hdx.data.resource import Resource
+
+        resource = Resource(self.resourcedata)
+        resource.set_file_type("csv")
+        resource.set_file_to_upload(self.path)
+        dataset.add_update_resource(resource)
+        self.added = True
+        return True
+
+    def add_formats_to_dataset(self, dataset):
+        """
+        Add the files in the other formats as resources of the dataset if the csv was added. They are added after the
+        other resources so that the positions of the csv resources (eg. QuickCharts) do not change.
+        """
+        if not self.added:
+            return
+        from hdx.data.hdxobject import HDXError
+        from hdx.data.resource import Resource
+
+        for writer in self.writers:
+            resource = Resource(self.resourcedata)
+            resource["name"] = "%s (%s)" % (self.resourcedata["name"], writer.format)
+            try:
+                resource.set_file_type(writer.file_type)
+            except HDXError:
+                logger.warning("HDX does not accept file type %s. %s not added" % (writer.file_type, writer.path))
+                continue
+            resource.set_file_to_upload(writer.path)
+            dataset.add_update_resource(resource)
+
+
+def country_fingerprint(countrydata, headers, config, qc_indicators, output_formats=()):
+    """
+    Hash of a country's rows together with the configuration used to turn them into a dataset. If the fingerprint is
+    the same as that of the last successful upload, the dataset would not change.
+    """
+    fingerprint = hashlib.sha256()
+    settings = [hxltags, qc_indicators]
+    if output_formats:
+        settings.append(list(output_formats))
+    fingerprint.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for report_id in sorted(countrydata.keys()):
+        report_headers = headers[report_id]
+        fingerprint.update(json.dumps([report_id, report_headers, config.get(report_id)], sort_keys=True).encode("utf-8"))
+        for row in countrydata[report_id]:
+            values = (str(row.get(header, "")) for header in report_headers)
+            fingerprint.update(("\x1e%s" % "\x1f".join(values)).encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+TAGS = ["hxl", "children", "COVID-19", "malnutrition", "hygiene", "health", "healthcare"]
+
+
+class RunMetadata(object):
+    """
+    Everything generate_dataset_and_showcase needs that depends only on the configuration or the country: the merged
+    HXL hashtags, the QuickCharts indicators and columns, dataset and showcase templates and each country's names,
+    slug, titles and HDX location. It is worked out once per run so that generating a country's dataset only does
+    lookups.
+    """
+
+    def __init__(self, config, qc_indicators, countries=()):
+        from hdx.data.dataset import Dataset
+        from hdx.data.showcase import Showcase
+
+        self.hxltags = {**hxltags, **hxltags_from_config(config)}
+        self.qc_codes = [x["code"] for x in qc_indicators]
+        self.qc_columns = {key for key, value in self.hxltags.items() if value in QC_CUTDOWN_HASHTAGS}
+        dataset = Dataset()
+        dataset.set_maintainer("196196be-6037-4488-8b71-d786adf4c081")
+        dataset.set_organization("3ab17ac1-1196-4501-a4dc-a01d2e52ff7c")
+        dataset.set_subnational(False)
+        dataset.set_expected_update_frequency("Every month")
+        dataset.add_tags(TAGS)
+        self.dataset_template = dataset.data
+        showcase = Showcase(
+            {
+                "notes": "Coronavirus (COVID-19) Global Response situation reports",
+                "url": "https://www.unicef.org/appeals/covid-19/situation-reports",
+                "image_url": "https://sites.unicef.org/includes/images/unicef_for-every-child_EN.png",
+            }
+        )
+        showcase.add_tags(TAGS)
+        self.showcase_template = showcase.data
+        self.countries = dict()
+        for country in countries:
+            self.country(country)
+
+    def country(self, country):
+        """Names, slug, titles and HDX location groups (None if not recognised) of a country, worked out once."""
+        countrymetadata = self.countries.get(country["iso3"])
+        if countrymetadata is not None:
+            return countrymetadata
+        from hdx.data.dataset import Dataset
+        from hdx.data.hdxobject import HDXError
+        from slugify import slugify
+
+        countryname = country["name"]
+        countryiso = country["iso3"].lower()
+        if countryiso == WORLD:
+            title = "Global COVID-19 Situation Report"
+        else:
+            title = "%s - COVID-19 Situation Report" % countryname
+        name = "UNICEF COVID-19 situation report for %s" % countryname
+        location = Dataset()
         try:
-            dataset.add_country_location(countryiso)
+            if countryiso == WORLD:
+                location.add_other_location("world")
+            else:
+                location.add_country_location(countryiso)
+            groups = location.data["groups"]
         except HDXError:
-            logger.error(f"{countryname} ({countryiso})  not recognised!")
-            return None, None
+            groups = None
+        countrymetadata = self.countries[country["iso3"]] = {
+            "countryname": countryname,
+            "countryiso": countryiso,
+            "title": title,
+            "name": name,
+            "slugified_name": slugify(name).lower(),
+            "groups": groups,
+        }
+        return countrymetadata
 
-    ################################################################
-    # Concatenated reports
-    ################################################################
 
-    joined_rows, joined_headers = concat_reports(countrydata)
+def segments_filename(countryiso):
+    """Name of the file recording the segments of the csvs written for a country (see write_country_files)."""
+    return "covid19sitrep_segments_%s.json" % countryiso
 
-    filename = "covid19sitrep_concat_%s.csv" % countryiso
 
-    resourcedata = {
-        "name": "Concatenated COVID-19 Situation Report Data - %s" % (countryname),
-        "description": "Data concatenated from all situational reports",
-        "countryiso": countryiso,
-        "countryname": countryname,
-    }
-    values = [x['code'] for x in qc_indicators]
-    success, results = dataset.generate_resource_from_iterator(
-        joined_headers,
-        joined_rows,
-        {**hxltags, **hxltags_from_config(config)},
+def resource_files(folder, countryiso, countryname, report_ids, headers, config, metadata, writers=()):
+    """Open the concatenated, QuickCharts and individual report csvs of a country."""
+    config_hxltags = metadata.hxltags
+    concat = ResourceFile(
+        folder,
+        "covid19sitrep_concat_%s.csv" % countryiso,
+        concat_headers(report_ids, headers),
+        config_hxltags,
+        {
+            "name": "Concatenated COVID-19 Situation Report Data - %s" % (countryname),
+            "description": "Data concatenated from all situational reports",
+            "countryiso": countryiso,
+            "countryname": countryname,
+        },
+        writers,
+    )
+    # QuickCharts cut down of the concatenated data: rows for the qc indicators with numeric values
+    qc_columns = metadata.qc_columns
+    quickcharts = ResourceFile(
         folder,
-        filename,
-        resourcedata,
-        datecol="TIME_PERIOD",
-        quickcharts={'hashtag': '#indicator+code', 'values': values, 'numeric_hashtag': '#indicator+value+num',
-                     'cutdown': 2, 'cutdownhashtags': ['#indicator+code', '#country+code', '#date', '#indicator+value+num']}
+        "qc_%s" % concat.filename,
+        [x for x in concat.headers if x in qc_columns],
+        config_hxltags,
+        {"name": "QuickCharts-%s" % concat.resourcedata["name"], "description": "Cut down data for QuickCharts"},
     )
-    bites_disabled = results["bites_disabled"]
-    if success is False:
-        logger.warning("Concatenated resource %s has no data!" % filename)
+    reports = dict()
+    for report_id in report_ids:
+        resource_config = config[report_id]
+        filename = resource_config["filename"] + "_%s.csv" % countryiso
+        logger.info("Creating resource %s for report %s in %s" % (filename,report_id,countryiso))
+        reports[report_id] = ResourceFile(
+            folder,
+            filename,
+            headers[report_id],
+            hxltags,
+            {
+                "name": "%s - %s" % (resource_config["name"], countryname),
+                "description": resource_config["description"],
+                "countryiso": countryiso,
+                "countryname": countryname,
+            },
+        )
+    return concat, quickcharts, reports
 
 
-    ################################################################
-    # Joined reports
-    ################################################################
+def joined_file(folder, countryiso, countryname, joined_headers, metadata, writers=()):
+    """Open the joined csv of a country."""
+    return ResourceFile(
+        folder,
+        "covid19sitrep_joined_%s.csv" % countryiso,
+        joined_headers,
+        metadata.hxltags,
+        {
+            "name": "Joined COVID-19 Situation Report Data - %s" % (countryname),
+            "description": "Data joined from all situational reports",
+            "countryiso": countryiso,
+            "countryname": countryname,
+        },
+        writers,
+    )
 
-    joined_rows, joined_headers = join_reports(countrydata, config)
 
-    filename = "covid19sitrep_joined_%s.csv" % countryiso
+def quickcharts_matches(row, qc_codes, bites_disabled):
+    """
+    Number of QuickCharts indicators that row is a numeric value of (the number of times it goes in the QuickCharts
+    csv). The bites of those indicators are enabled.
+    """
+    matches = 0
+    for i, lookup in enumerate(qc_codes):
+        if row["SITREP_INDICATOR"] == lookup:
+            try:
+                float(row["OBS_VALUE"])
+            except (TypeError, ValueError):
+                continue
+            bites_disabled[i] = False
+            matches += 1
+    return matches
+
+
+def date_range(resourcefile):
+    if resourcefile.startdate is None:
+        return None
+    return [resourcefile.startdate.isoformat(), resourcefile.enddate.isoformat()]
+
+
+def write_country_files(folder, country, countryname, countrydata, headers, config, metadata, join_engine="python",
+                        writers=(), qc_index=None):
+    """
+    Write the concatenated, QuickCharts, joined and report csvs of a country in one pass over its rows, saving their
+    segments to segments_filename for merge_world_files. Returns the (open) ResourceFiles and bites_disabled.
+    """
+    from hdx.utilities.dateparse import parse_date
+
+    countryiso = country["iso3"].lower()
+    concat, quickcharts, reports = resource_files(
+        folder, countryiso, countryname, countrydata.keys(), headers, config, metadata, writers
+    )
+    qc_codes = metadata.qc_codes
+    bites_disabled = [True, True, True]
+    # The Python join is done in the same pass as the other files, joining the reports in countrydata order although
+    # their rows are written in sorted report order
+    joiner = ReportJoiner(config, countrydata.keys()) if join_engine == "python" else None
+    # Position (in countrydata order) of the first report with each joined key: the joined rows of a report follow
+    # those of the reports before it
+    key_fields = ReportJoiner.key_fields
+    positions = {report_id: position for position, report_id in enumerate(countrydata.keys())}
+    firstreport = dict()
+
+    with timer("write_csv", country["iso3"]):
+        dates = dict()
+        for report_id in sorted(countrydata.keys()):
+            report = reports[report_id]
+            position = positions[report_id]
+            for row in countrydata[report_id]:
+                datestr = row["TIME_PERIOD"]
+                if datestr:
+                    date = dates.get(datestr)
+                    if date is None:
+                        date = dates[datestr] = parse_date(datestr)
+                else:
+                    date = None
+                concat.writerow(row, date)
+                report.writerow(row, date)
+                if joiner:
+                    joiner.add(report_id, row)
+                key = tuple(row.get(field) for field in key_fields)
+                if firstreport.get(key, position) >= position:
+                    firstreport[key] = position
+                if qc_index is None:
+                    for _ in range(quickcharts_matches(row, qc_codes, bites_disabled)):
+                        quickcharts.writerow(row)
+        if qc_index is not None:
+            for row in qc_index.cutdown_rows():
+                quickcharts.writerow(row)
+            bites_disabled = qc_index.bites_disabled()
 
-    resourcedata = {
-        "name": "Joined COVID-19 Situation Report Data - %s" % (countryname),
-        "description": "Data joined from all situational reports",
-        "countryiso": countryiso,
-        "countryname": countryname,
+    with timer("join", country["iso3"]):
+        if joiner:
+            joined_rows, joined_headers = joiner.rows(), joiner.headers
+        else:
+            joined_rows, joined_headers = join_reports(countrydata, config, join_engine)
+        joined = joined_file(folder, countryiso, countryname, joined_headers, metadata, writers)
+        report_ids = list(countrydata.keys())
+        joined_segments = list()
+        for row in joined_rows:
+            joined.writerow(row)
+            report_id = report_ids[firstreport[tuple(row.get(field) for field in key_fields)]]
+            if joined_segments and joined_segments[-1][0] == report_id:
+                joined_segments[-1][1] += 1
+            else:
+                joined_segments.append([report_id, 1])
+    # Every row contributes to the joined data so its dates are those of the concatenated data
+    if concat.startdate is not None:
+        joined.add_dates(concat.startdate, concat.enddate)
+
+    segments = {
+        "concat": {
+            "filename": concat.filename,
+            "segments": [[report_id, reports[report_id].rows] for report_id in sorted(countrydata.keys())],
+            "dates": date_range(concat),
+        },
+        "joined": {"filename": joined.filename, "segments": joined_segments},
+        "reports": {
+            report_id: {"filename": report.filename, "rows": report.rows, "dates": date_range(report)}
+            for report_id, report in reports.items()
+        },
     }
+    with open(join(folder, segments_filename(countryiso)), "w", encoding="utf-8") as output:
+        json.dump(segments, output)
+    return concat, quickcharts, joined, reports, bites_disabled
 
-    success, results = dataset.generate_resource_from_iterator(
-        joined_headers,
-        joined_rows,
-        {**hxltags, **hxltags_from_config(config)},
-        folder,
-        filename,
-        resourcedata,
-        datecol="TIME_PERIOD",
+
+def read_segments(path, segments, positions, countrypositions, countryiso):
+    """
+    Yield ((report position, country position), row) for the data rows of a csv written as segments of rows of each
+    report, where positions gives the order of the reports and countrypositions the order of the countries in each.
+    """
+    with open(path, newline="", encoding="utf-8") as input:
+        reader = csv.reader(input)
+        fields = next(reader)
+        next(reader)  # HXL row
+        for report_id, rows in segments:
+            key = (positions[report_id], countrypositions[report_id][countryiso])
+            for values in islice(reader, rows):
+                yield key, dict(zip(fields, values))
+
+
+def merge_world_files(folder, countryname, countrydata, headers, config, metadata, merge_countries,
+                      join_engine="python", writers=(), qc_index=None):
+    """
+    Write the world csvs by merging the csvs already written in folder for each country in merge_countries (the
+    others are written first), holding only a row per country in memory. Returns the same as write_country_files.
+    """
+    report_ids = list(countrydata.keys())
+    # The order of the countries in each report's rows
+    countryorders = {
+        report_id: [countryiso for countryiso in countrydata[report_id].countriesdata if countryiso != WORLD]
+        for report_id in report_ids
+    }
+    countrypositions = {
+        report_id: {countryiso: position for position, countryiso in enumerate(countryorder)}
+        for report_id, countryorder in countryorders.items()
+    }
+    countryisos = list(dict.fromkeys(countryiso for countryorder in countryorders.values() for countryiso in countryorder))
+    segments = dict()
+    written = 0
+    for countryiso in countryisos:
+        path = join(folder, segments_filename(countryiso.lower()))
+        if countryiso not in merge_countries or not exists(path):
+            countrycountrydata = {
+                report_id: countrydata[report_id].countriesdata[countryiso]
+                for report_id in report_ids
+                if countryiso in countrypositions[report_id]
+            }
+            concat, quickcharts, joined, reports, _ = write_country_files(
+                folder, {"iso3": countryiso}, country_name(countryiso) or countryiso, countrycountrydata, headers,
+                config, metadata, join_engine, qc_index=qc_index.country(countryiso) if qc_index is not None else None
+            )
+            for resourcefile in (concat, quickcharts, joined, *reports.values()):
+                resourcefile.close()
+            written += 1
+        with open(path, encoding="utf-8") as input:
+            segments[countryiso] = json.load(input)
+    logger.info("Merging world csvs from %d countries (%d written for the world)" % (len(countryisos), written))
+
+    concat, quickcharts, reports = resource_files(
+        folder, WORLD, countryname, report_ids, headers, config, metadata, writers
     )
-    if success is False:
-        logger.warning("Joined resource %s has no data!" % filename)
+    qc_codes = metadata.qc_codes
+    bites_disabled = [True, True, True]
+    with timer("merge_world", WORLD):
+        # Rows are merged in report and then country order: sorted report order for the concatenated csv and
+        # countrydata order for the joined csv, as written by write_country_files
+        sortedpositions = {report_id: position for position, report_id in enumerate(sorted(report_ids))}
+        rows = heapq.merge(
+            *(
+                read_segments(join(folder, countrysegments["concat"]["filename"]),
+                              countrysegments["concat"]["segments"], sortedpositions, countrypositions, countryiso)
+                for countryiso, countrysegments in segments.items()
+            ),
+            key=itemgetter(0),
+        )
+        for _, row in rows:
+            concat.writerow(row)
+            if qc_index is None:
+                for _ in range(quickcharts_matches(row, qc_codes, bites_disabled)):
+                    quickcharts.writerow(row)
+        if qc_index is not None:
+            for row in qc_index.cutdown_rows():
+                quickcharts.writerow(row)
+            bites_disabled = qc_index.bites_disabled()
+        for countrysegments in segments.values():
+            if countrysegments["concat"]["dates"]:
+                concat.add_dates(*(datetime.fromisoformat(date) for date in countrysegments["concat"]["dates"]))
 
-    ################################################################
-    # Individual reports
-    ################################################################
+        # The joined headers are those of the reports with rows, in report order
+        joined_headers = ReportJoiner.key_fields[:]
+        for report_id in report_ids:
+            if any(countrysegments["reports"].get(report_id, {}).get("rows") for countrysegments in segments.values()):
+                for destination_field, _ in field_mappings(config, report_id):
+                    if destination_field not in joined_headers:
+                        joined_headers.append(destination_field)
+        joined = joined_file(folder, WORLD, countryname, joined_headers, metadata, writers)
+        positions = {report_id: position for position, report_id in enumerate(report_ids)}
+        rows = heapq.merge(
+            *(
+                read_segments(join(folder, countrysegments["joined"]["filename"]),
+                              countrysegments["joined"]["segments"], positions, countrypositions, countryiso)
+                for countryiso, countrysegments in segments.items()
+            ),
+            key=itemgetter(0),
+        )
+        for _, row in rows:
+            joined.writerow(row)
+        if concat.startdate is not None:
+            joined.add_dates(concat.startdate, concat.enddate)
 
-    for report_id in countrydata.keys():
-        resource_config = config[report_id]
-        filename = resource_config["filename"] + "_%s.csv" % countryiso
-        logger.info("Creating resource %s for report %s in %s" % (filename,report_id,countryiso))
-        resourcedata = {
-            "name": "%s - %s" % (resource_config["name"], countryname),
-            "description": resource_config["description"],
-            "countryiso": countryiso,
-            "countryname": countryname,
-        }
-        success, results = dataset.generate_resource_from_iterator(
-            headers[report_id],
-            countrydata[report_id],
-            hxltags,
-            folder,
-            filename,
-            resourcedata,
-            datecol="TIME_PERIOD",
+        for report_id, report in reports.items():
+            for countryiso in countryorders[report_id]:
+                countryreport = segments[countryiso]["reports"][report_id]
+                report.copy_rows(join(folder, countryreport["filename"]), countryreport["rows"])
+                if countryreport["dates"]:
+                    report.add_dates(*(datetime.fromisoformat(date) for date in countryreport["dates"]))
+    return concat, quickcharts, joined, reports, bites_disabled
+
+
+def generate_dataset_and_showcase(folder, country, countrydata, headers, config, qc_indicators, join_engine="python",
+                                  metadata=None, output_formats=(), merge_countries=None, qc_index=None):
+    """
+    Write the csvs of a country (merged from the countries' csvs for the world if merge_countries is given) and
+    create its dataset and showcase. metadata (a RunMetadata) should be shared by all countries of a run.
+    """
+    from hdx.data.dataset import Dataset
+    from hdx.data.showcase import Showcase
+
+    if metadata is None:
+        metadata = RunMetadata(config, qc_indicators)
+    countrymetadata = metadata.country(country)
+    countryname = countrymetadata["countryname"]
+    countryiso = countrymetadata["countryiso"]
+    title = countrymetadata["title"]
+    logger.info("Creating dataset: %s" % title)
+    slugified_name = countrymetadata["slugified_name"]
+    if countrymetadata["groups"] is None:
+        logger.error(f"{countryname} ({countryiso})  not recognised!")
+        return None, None, None
+    dataset = Dataset({"name": slugified_name, "title": title, **deepcopy(metadata.dataset_template)})
+    dataset["groups"] = deepcopy(countrymetadata["groups"])
+
+    writers = output_writers(output_formats)
+    if country["iso3"] == WORLD and merge_countries is not None:
+        concat, quickcharts, joined, reports, bites_disabled = merge_world_files(
+            folder, countryname, countrydata, headers, config, metadata, merge_countries, join_engine, writers,
+            qc_index
         )
-        if success is False:
-            logger.warning("%s has no data!" % filename)
+    else:
+        concat, quickcharts, joined, reports, bites_disabled = write_country_files(
+            folder, country, countryname, countrydata, headers, config, metadata, join_engine, writers, qc_index
+        )
+
+    if concat.add_to_dataset(dataset):
+        # As generate_resource_from_iterator did, the QuickCharts resource is added even if it has no rows
+        quickcharts.add_to_dataset(dataset, check_dates=False, allow_empty=True)
+        dataset.set_date_of_dataset(concat.startdate, concat.enddate)
+    else:
+        logger.warning("Concatenated resource %s has no data!" % concat.filename)
+        quickcharts.close()
+        remove(quickcharts.path)
+
+    if joined.add_to_dataset(dataset) is False:
+        logger.warning("Joined resource %s has no data!" % joined.filename)
+
+    for report in reports.values():
+        if report.add_to_dataset(dataset) is False:
+            logger.warning("%s has no data!" % report.filename)
+    concat.add_formats_to_dataset(dataset)
+    joined.add_formats_to_dataset(dataset)
+    resourcefiles = [concat, joined, *reports.values()]
+    if exists(quickcharts.path):
+        resourcefiles.append(quickcharts)
+    count("files_written", sum(1 + len(resourcefile.writers) for resourcefile in resourcefiles), country["iso3"])
+    for resourcefile in resourcefiles:
+        for output_format, size in resourcefile.sizes().items():
+            count("bytes_written_%s" % output_format, size, country["iso3"])
 
     showcase = Showcase(
         {
             "name": "%s-showcase" % slugified_name,
-            "title": name,
-            "notes": "Coronavirus (COVID-19) Global Response situation reports",
-            "url": "https://www.unicef.org/appeals/covid-19/situation-reports",
-            "image_url": "https://sites.unicef.org/includes/images/unicef_for-every-child_EN.png",
+            "title": countrymetadata["name"],
+            **deepcopy(metadata.showcase_template),
         }
     )
-    showcase.add_tags(
-        [
-            "hxl",
-            "children",
-            "COVID-19",
-            "malnutrition",
-            "hygiene",
-            "health",
-            "healthcare",
-        ]
-    )
     return dataset, showcase, bites_disabled
+
+
+def build_dataset_and_showcase(folder, country, countrydata, headers, config, qc_indicators, join_engine="python",
+                               metadata=None, output_formats=(), merge_countries=None, qc_index=None):
+    """
+    Run generate_dataset_and_showcase in a worker process. Returns the dataset, its resources and the showcase as
+    plain dictionaries for restore_dataset_and_showcase, bites_disabled, the time taken and the metrics recorded.
+    """
+    start = perf_counter()
+    with capture() as buildmetrics:
+        with timer("build", country["iso3"]):
+            dataset, showcase, bites_disabled = generate_dataset_and_showcase(
+                folder, country, countrydata, headers, config, qc_indicators, join_engine, metadata, output_formats,
+                merge_countries, qc_index
+            )
+    if dataset is None:
+        return None, perf_counter() - start, buildmetrics.report()
+    resources = [(resource.data, resource.get_file_to_upload()) for resource in dataset.get_resources()]
+    return (dataset.data, resources, showcase.data, bites_disabled), perf_counter() - start, buildmetrics.report()
+
+
+def restore_dataset_and_showcase(built):
+    """Recreate the dataset and showcase from the output of build_dataset_and_showcase."""
+    from hdx.data.dataset import Dataset
+    from hdx.data.resource import Resource
+    from hdx.data.showcase import Showcase
+
+    datasetdata, resources, showcasedata, bites_disabled = built
+    dataset = Dataset(datasetdata)
+    for resourcedata, file_to_upload in resources:
+        resource = Resource(resourcedata)
+        resource.set_file_to_upload(file_to_upload)
+        dataset.add_update_resource(resource)
+    return dataset, Showcase(showcasedata), bites_disabled